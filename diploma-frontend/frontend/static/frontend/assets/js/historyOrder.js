@@ -1,14 +1,21 @@
 var mix = {
 	methods: {
-		getHistoryOrder() {
-			this.getData("/api/orders")
+		getHistoryOrder(url = "/api/orders") {
+			this.loading = true
+			this.getData(url)
 				.then(data => {
-					console.log(data)
-					this.orders = data
+					this.orders = [...this.orders, ...data.items]
+					this.next = data.next
 				}).catch(() => {
-				this.orders = []
 				console.warn('Ошибка при получении списка заказов')
+			}).finally(() => {
+				this.loading = false
 			})
+		},
+		getMoreOrders() {
+			if (this.next && !this.loading) {
+				this.getHistoryOrder(this.next)
+			}
 		}
 	},
 	mounted() {
@@ -17,6 +24,8 @@ var mix = {
 	data() {
 		return {
 			orders: [],
+			next: null,
+			loading: false,
 		}
 	}
 }
\ No newline at end of file
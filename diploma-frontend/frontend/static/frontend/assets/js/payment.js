@@ -17,17 +17,28 @@ var mix = {
 				year: this.year,
 				month: this.month,
 				code: this.code
-			}).then(() => {
-				alert('Успешная оплата')
+			}).then(({ data: { statusUrl } }) => {
 				this.number1 = ''
 				this.name = ''
 				this.year = ''
 				this.month = ''
 				this.code = ''
-				location.assign('/')
+				this.waitPayment(statusUrl)
 			}).catch(() => {
 			 	console.warn('Ошибка при оплате')
 			})
+		},
+		waitPayment(statusUrl) {
+			this.getData(statusUrl).then(({ status, payment }) => {
+				if (status === 'Paid') {
+					alert('Успешная оплата')
+					location.assign('/')
+				} else if (payment && payment.status === 'failed') {
+					alert('Ошибка при оплате')
+				} else {
+					setTimeout(() => this.waitPayment(statusUrl), 1000)
+				}
+			})
 		}
 	},
 	data() {
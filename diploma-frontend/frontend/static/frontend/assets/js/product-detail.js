@@ -33,7 +33,9 @@ var mix = {
                 text: this.review.text,
                 rate: this.review.rate
             }).then(({data}) => {
-                this.product.reviews = data
+                this.product.reviews = [data.review, ...this.product.reviews]
+                this.product.reviewsCount = data.reviewsCount
+                this.product.rating = data.rating
                 alert('Отзыв опубликован')
                 this.review.author = ''
                 this.review.email = ''
@@ -43,6 +45,14 @@ var mix = {
                 console.warn('Ошибка при публикации отзыва')
             })
         },
+        getMoreReviews () {
+            this.getData(this.product.reviewsNext).then(data => {
+                this.product.reviews = [...this.product.reviews, ...data.items]
+                this.product.reviewsNext = data.next
+            }).catch(() => {
+                console.warn('Ошибка при получении отзывов')
+            })
+        },
         setActivePhoto(index) {
             this.activePhoto = index
         }
@@ -20,6 +20,66 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 
 BASKET_SESSION_ID = 'basket'
 
+BASKET_TOKEN_SESSION_ID = 'basket_token'
+
+BASKET_STORE = 'shop_app.basket.DatabaseBasketStore'
+
+BASKET_CACHE_TIMEOUT = 60 * 60 * 24 * 14
+
+BASKET_ANONYMOUS_TTL = 60 * 60 * 24 * 14
+
+STOCK_RESERVATION_TIMEOUT = 60 * 30
+
+IDEMPOTENCY_KEY_HEADER = 'Idempotency-Key'
+
+IDEMPOTENCY_KEY_TTL = 60 * 60 * 24
+
+IDEMPOTENCY_KEY_LEASE = 60
+
+PAYMENT_GATEWAY = 'shop_app.payments.FakePaymentGateway'
+
+PAYMENT_MAX_ATTEMPTS = 5
+
+PAYMENT_RETRY_DELAY = 30
+
+PAYMENT_JOB_TIMEOUT = 60 * 5
+
+BASKET_PRICE_CACHE_TIMEOUT = 30
+
+SALE_PRICES_CACHE_TIMEOUT = 60 * 5
+
+SALE_SCHEDULER_INTERVAL = 60
+
+PRODUCT_EMBEDDED_REVIEWS = 5
+
+SHOP_CACHE_ALIAS = 'default'
+
+SHOP_RESPONSE_CACHE_TIMEOUT = 60 * 15
+
+# Maximum age of the cached shop data when SHOP_CACHE_ALIAS is a cache local
+# to the process, a shared cache (Redis, Memcached) is invalidated at once
+SHOP_LOCAL_GENERATION_TIMEOUT = 60
+
+CATALOG_COUNT_CACHE_TIMEOUT = 60
+
+BANNERS_LIMIT = 5
+
+RANKING_CACHE_TIMEOUT = 60 * 60
+
+RANKING_HALF_LIFE_DAYS = 7
+
+RANKING_MAX_WINDOW_DAYS = 90
+
+CATALOG_FACETS_CACHE_TIMEOUT = 60
+
+CATALOG_FACETS_PRICE_BUCKETS = 10
+
+# Dotted path of the search backend, unset it is picked by the database:
+# FTS5 on SQLite and the index-free backend on the other databases
+PRODUCT_SEARCH_BACKEND = None
+
+PRODUCT_SEARCH_LIMIT = 20
+
 
 # Quick-start development settings - unsuitable for production
 # See https://docs.djangoproject.com/en/4.2/howto/deployment/checklist/
@@ -90,6 +150,16 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        'OPTIONS': {
+            'timeout': 20,
+        },
+    }
+}
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'LOCATION': 'megano',
     }
 }
 
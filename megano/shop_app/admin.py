@@ -116,8 +116,10 @@ class ProductAdmin(admin.ModelAdmin):
         "count_p",
         "data_created",
         "free_delivery",
+        "featured",
     )
     list_display_links = "id", "title"
+    list_filter = "featured",
     ordering = "title",
     search_fields = "title", "price", "description",
 
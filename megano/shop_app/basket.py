@@ -1,9 +1,284 @@
+import datetime
+import uuid
 from decimal import Decimal
+from functools import lru_cache
+
 from django.conf import settings
+from django.db import transaction
+from django.db.models import Max
+from django.utils import timezone
+from django.utils.module_loading import import_string
 from rest_framework.request import Request
 
 
-from .models import Product, Sale
+from .cache import get_cache
+from .models import BasketLine, Product
+from .pricing import get_prices, get_sale_prices
+from .serializers import BasketItemSerializer, BasketTotalsSerializer
+
+
+def encode_lines(lines: dict) -> str:
+    """
+    Compact form of the basket lines, '12:3,15:1'
+    """
+    return ','.join(f'{product_id}:{count}' for product_id, count in lines.items())
+
+
+def decode_lines(data) -> dict:
+    """
+    Basket lines from the compact form, the dicts written by the previous
+    session format are read as well
+    """
+    if not data:
+        return {}
+    if isinstance(data, dict):
+        return {
+            int(product_id): int(item['count'] if isinstance(item, dict) else item)
+            for product_id, item in data.items()
+        }
+    lines = {}
+    for line in data.split(','):
+        product_id, count = line.split(':')
+        lines[int(product_id)] = int(count)
+    return lines
+
+
+class BasketStore(object):
+    """
+    Storage of the basket lines {product_id: count}, a line is written
+    on its own without rewriting the rest of the basket where possible
+    """
+
+    def __init__(self, request: Request):
+        self.request = request
+        self.session = request.session
+
+    def load(self) -> dict:
+        raise NotImplementedError
+
+    def set_count(self, product_id: int, count: int) -> None:
+        """
+        Write a single line, a count below one removes the line
+        """
+        raise NotImplementedError
+
+    def set_counts(self, counts: dict) -> None:
+        """
+        Write several lines at once
+        """
+        for product_id, count in counts.items():
+            self.set_count(product_id, count)
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def merge_anonymous(self, user) -> None:
+        """
+        Move the basket of the anonymous session into the basket of the user
+        who has just signed in
+        """
+
+
+class SessionBasketStore(BasketStore):
+    """
+    Lines in the session in the compact form, the session keeps its data
+    on sign in so there is nothing to merge
+    """
+
+    def load(self) -> dict:
+        self.lines = decode_lines(self.session.get(settings.BASKET_SESSION_ID))
+        return dict(self.lines)
+
+    def set_count(self, product_id: int, count: int) -> None:
+        self.set_counts({product_id: count})
+
+    def set_counts(self, counts: dict) -> None:
+        for product_id, count in counts.items():
+            if count > 0:
+                self.lines[product_id] = count
+            else:
+                self.lines.pop(product_id, None)
+        self.session[settings.BASKET_SESSION_ID] = encode_lines(self.lines)
+
+    def clear(self) -> None:
+        self.lines = {}
+        self.session.pop(settings.BASKET_SESSION_ID, None)
+
+
+class OwnerBasketStore(BasketStore):
+    """
+    Baskets kept outside the session under the owner key, 'user:<id>' for
+    a signed in user and 'anon:<token>' for an anonymous session
+    """
+
+    def get_owner(self, create: bool = False):
+        user = getattr(self.request, 'user', None)
+        if user is not None and user.is_authenticated:
+            return f'user:{user.pk}'
+        return self.get_anonymous_owner(create)
+
+    def get_anonymous_owner(self, create: bool = False):
+        token = self.session.get(settings.BASKET_TOKEN_SESSION_ID)
+        if token is None:
+            if not create:
+                return None
+            token = self.session[settings.BASKET_TOKEN_SESSION_ID] = uuid.uuid4().hex
+        return f'anon:{token}'
+
+    def read(self, owner: str) -> dict:
+        raise NotImplementedError
+
+    def write_line(self, owner: str, product_id: int, count: int) -> None:
+        raise NotImplementedError
+
+    def write_lines(self, owner: str, counts: dict) -> None:
+        with transaction.atomic():
+            for product_id, count in counts.items():
+                self.write_line(owner, product_id, count)
+
+    def delete(self, owner: str) -> None:
+        raise NotImplementedError
+
+    def add_lines(self, owner: str, lines: dict) -> None:
+        """
+        Add the counts of the lines to the basket of the owner
+        """
+        current = self.read(owner)
+        self.write_lines(owner, {
+            product_id: current.get(product_id, 0) + count
+            for product_id, count in lines.items()
+        })
+
+    def load(self) -> dict:
+        """
+        Lines of the basket, a basket left in the session by the session
+        store is moved into this store on the first read
+        """
+        lines = decode_lines(self.session.pop(settings.BASKET_SESSION_ID, None))
+        if lines:
+            owner = self.get_owner(create=True)
+            with transaction.atomic():
+                self.add_lines(owner, lines)
+            return self.read(owner)
+        owner = self.get_owner()
+        return self.read(owner) if owner else {}
+
+    def set_count(self, product_id: int, count: int) -> None:
+        self.write_line(self.get_owner(create=True), product_id, count)
+
+    def set_counts(self, counts: dict) -> None:
+        self.write_lines(self.get_owner(create=True), counts)
+
+    def clear(self) -> None:
+        owner = self.get_owner()
+        if owner:
+            self.delete(owner)
+
+    def merge_anonymous(self, user) -> None:
+        source = self.get_anonymous_owner()
+        if source is None:
+            return
+        target = f'user:{user.pk}'
+        with transaction.atomic():
+            self.add_lines(target, self.read(source))
+            self.delete(source)
+        self.session.pop(settings.BASKET_TOKEN_SESSION_ID, None)
+
+
+class CacheBasketStore(OwnerBasketStore):
+    """
+    Baskets in the shop cache, one entry in the compact form per owner
+    """
+
+    def get_key(self, owner: str) -> str:
+        return f'shop_app:basket:{owner}'
+
+    def read(self, owner: str) -> dict:
+        return decode_lines(get_cache().get(self.get_key(owner)))
+
+    def write_line(self, owner: str, product_id: int, count: int) -> None:
+        self.write_lines(owner, {product_id: count})
+
+    def write_lines(self, owner: str, counts: dict) -> None:
+        lines = self.read(owner)
+        for product_id, count in counts.items():
+            if count > 0:
+                lines[product_id] = count
+            else:
+                lines.pop(product_id, None)
+        if lines:
+            get_cache().set(self.get_key(owner), encode_lines(lines), settings.BASKET_CACHE_TIMEOUT)
+        else:
+            self.delete(owner)
+
+    def delete(self, owner: str) -> None:
+        get_cache().delete(self.get_key(owner))
+
+
+class DatabaseBasketStore(OwnerBasketStore):
+    """
+    Baskets in the BasketLine table, a change touches only the row of its line
+    """
+
+    def read(self, owner: str) -> dict:
+        return dict(
+            BasketLine.objects
+            .filter(owner=owner)
+            .values_list('product', 'count')
+        )
+
+    def write_line(self, owner: str, product_id: int, count: int) -> None:
+        self.write_lines(owner, {product_id: count})
+
+    def write_lines(self, owner: str, counts: dict) -> None:
+        """
+        Removed lines are deleted, the rest are upserted in one statement
+        """
+        removed = [product_id for product_id, count in counts.items() if count <= 0]
+        with transaction.atomic():
+            if removed:
+                BasketLine.objects.filter(owner=owner, product__in=removed).delete()
+            BasketLine.objects.bulk_create(
+                [
+                    BasketLine(owner=owner, product_id=product_id, count=count)
+                    for product_id, count in counts.items()
+                    if count > 0
+                ],
+                update_conflicts=True,
+                unique_fields=['owner', 'product'],
+                update_fields=['count', 'updated_at'],
+            )
+
+    def delete(self, owner: str) -> None:
+        BasketLine.objects.filter(owner=owner).delete()
+
+
+def purge_anonymous(now=None) -> int:
+    """
+    Delete the table baskets of the anonymous sessions untouched for
+    BASKET_ANONYMOUS_TTL, the cache store lets them expire on their own
+    """
+    expired = (now or timezone.now()) - datetime.timedelta(seconds=settings.BASKET_ANONYMOUS_TTL)
+    owners = BasketLine.objects\
+        .filter(owner__startswith='anon:')\
+        .values('owner')\
+        .annotate(last_update=Max('updated_at'))\
+        .filter(last_update__lte=expired)\
+        .values('owner')
+    deleted, _ = BasketLine.objects.filter(owner__in=owners).delete()
+    return deleted
+
+
+@lru_cache(maxsize=None)
+def get_basket_store_class():
+    return import_string(settings.BASKET_STORE)
+
+
+def get_basket_store(request: Request) -> BasketStore:
+    """
+    Store from the BASKET_STORE setting
+    """
+    return get_basket_store_class()(request)
 
 
 class Basket(object):
@@ -12,74 +287,136 @@ class Basket(object):
         """
         Initial basket
         """
-        self.session = request.session
-        basket = self.session.get(settings.BASKET_SESSION_ID)
-        if not basket:
-            basket = self.session[settings.BASKET_SESSION_ID] = {}
-        self.basket = basket
+        self.store = get_basket_store(request)
+        self.lines = self.store.load()
+        self._prices = None
 
     def __iter__(self):
         """
         Iterating the item in the basket
         """
-        products = Product.objects.filter(id__in=self.basket.keys())
-        basket = self.basket.copy()
-        for product in products:
-            basket[str(product.id)]['product'] = product
-
-        for item in basket.values():
-            item['price'] = Decimal(item['price'])
-            item['total_price'] = item['price'] * item['count']
-            yield item
+        prices = self.get_prices()
+        for product_id, count in self.lines.items():
+            price = prices.get(product_id)
+            if price is None:
+                continue
+            yield {
+                'product_id': product_id,
+                'count': count,
+                'price': price,
+                'total_price': price * count,
+            }
 
     def __len__(self):
-        return sum(item['count'] for item in self.basket.values())
+        return sum(self.lines.values())
 
-    def add(self, product: Product, count=1, update_count=False):
+    def get_prices(self) -> dict:
         """
-        Adding or updating an item in the basket
+        Current prices of the products in the basket, resolved on first use
         """
-        try:
-            sale = Sale.objects.get(product=product, status=True)
-            price = sale.sale_price
-        except Exception:
-            price = product.price_p
-        product_id = str(product.id)
-        if product_id not in self.basket:
-            self.basket[product_id] = {
-                'count': 0,
-                'price': str(price),
-            }
-        if update_count:
-            self.basket[product_id]['count'] = count
+        if self._prices is None:
+            self._prices = get_prices(self.lines.keys())
+        return self._prices
+
+    def get_products(self):
+        """
+        Products of the basket with their images and tags, the effective
+        price is set from the index of the active sale prices
+        """
+        products = list(
+            Product.objects
+            .filter(id__in=self.get_product_id())
+            .prefetch_related('images', 'tags')
+        )
+        sale_prices = get_sale_prices()
+        for product in products:
+            product.effective_price = sale_prices.get(product.id, product.price_p)
+        return products
+
+    def get_payload(self) -> dict:
+        """
+        Serialized lines of the basket and the totals over them
+        """
+        products = self.get_products()
+        self._prices = {product.id: product.effective_price for product in products}
+        counts = {product.id: self.lines[product.id] for product in products}
+        items = BasketItemSerializer(products, many=True, context={'counts': counts}).data
+        return {
+            'items': items,
+            'totals': BasketTotalsSerializer({
+                'lines': len(products),
+                'count': sum(counts.values()),
+                'price': sum(
+                    (product.effective_price * counts[product.id] for product in products),
+                    Decimal(0),
+                ),
+            }).data,
+        }
+
+    def set_count(self, product_id: int, count: int):
+        """
+        Writing a single line of the basket, a count below one removes it
+        """
+        product_id = int(product_id)
+        if count > 0:
+            self.lines[product_id] = count
+        elif product_id not in self.lines:
+            return
         else:
-            self.basket[product_id]['count'] += count
-        self.save()
+            del self.lines[product_id]
+        self._prices = None
+        self.store.set_count(product_id, count)
 
-    def save(self):
+    def apply(self, operations: list):
         """
-        Saving the item
+        Applying a batch of validated operations, the resulting counts are
+        written to the store at once
         """
-        self.session.modified = True
+        lines = dict(self.lines)
+        for operation in operations:
+            product_id, count = operation['id'], operation['count']
+            if operation['op'] == 'set':
+                lines[product_id] = count
+            elif operation['op'] == 'remove':
+                lines[product_id] = lines.get(product_id, 0) - count
+            else:
+                lines[product_id] = lines.get(product_id, 0) + count
+        counts = {
+            product_id: count
+            for product_id, count in lines.items()
+            if count != self.lines.get(product_id, 0)
+            and (count > 0 or product_id in self.lines)
+        }
+        if not counts:
+            return
+        self.lines = {product_id: count for product_id, count in lines.items() if count > 0}
+        self._prices = None
+        self.store.set_counts(counts)
+
+    def add(self, product_id: int, count=1, update_count=False):
+        """
+        Adding or updating an item in the basket
+        """
+        count = int(count)
+        if not update_count:
+            count += self.lines.get(int(product_id), 0)
+        self.set_count(product_id, count)
 
     def remove(self, product_id: int, count=1):
         """
         Remove item from basket
         """
-        s_product_id = str(product_id)
-        if s_product_id in self.basket:
-            if count == self.basket[s_product_id]['count']:
-                del self.basket[s_product_id]
-            else:
-                self.basket[s_product_id]['count'] -= count
-            self.save()
+        product_id = int(product_id)
+        if product_id in self.lines:
+            self.set_count(product_id, self.lines[product_id] - int(count))
 
     def get_total_price(self):
-        return sum(Decimal(item['price']) for item in self.basket.values())
+        return sum((item['total_price'] for item in self), Decimal(0))
 
     def clear(self):
-        del self.session[settings.BASKET_SESSION_ID]
-        self.save()
+        self.lines = {}
+        self._prices = None
+        self.store.clear()
 
     def get_product_id(self):
-        return [int(product) for product in self.basket.keys()]
+        return list(self.lines.keys())
@@ -0,0 +1,195 @@
+import hashlib
+import time
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from rest_framework.response import Response
+
+
+# Cached data is versioned by the generations of the resources it shows,
+# a change bumps only the generation of its own resource
+CATALOG = 'catalog'
+SALES = 'sales'
+STOCK = 'stock'
+CATEGORIES = 'categories'
+# Units sold by the products, the sales above are the sale promotions
+SOLD = 'sold'
+RESOURCES = (CATALOG, SALES, STOCK, CATEGORIES, SOLD)
+HITS_KEY = 'shop_app:stats:hits'
+MISSES_KEY = 'shop_app:stats:misses'
+
+
+def get_cache():
+    return caches[settings.SHOP_CACHE_ALIAS]
+
+
+def is_local_cache() -> bool:
+    """
+    A cache in the memory of the process, the other processes never see its entries
+    """
+    return isinstance(get_cache(), LocMemCache)
+
+
+def get_generation_timeout():
+    """
+    Generations in a shared cache are kept until bumped. A local cache never
+    hears of the bumps made by other processes, so its generations expire
+    after SHOP_LOCAL_GENERATION_TIMEOUT and data versioned by them is at
+    most that old
+    """
+    if is_local_cache():
+        return settings.SHOP_LOCAL_GENERATION_TIMEOUT
+    return None
+
+
+def get_generation_key(resource: str) -> str:
+    return f'shop_app:generation:{resource}'
+
+
+def get_generation(resource: str = CATALOG) -> int:
+    """
+    Current generation of the resource, the cached entries showing it are keyed by it
+    """
+    cache = get_cache()
+    key = get_generation_key(resource)
+    generation = cache.get(key)
+    if generation is None:
+        # A lost counter must not fall back to a generation used before
+        generation = int(time.time() * 1000)
+        cache.add(key, generation, get_generation_timeout())
+        generation = cache.get(key, generation)
+    return generation
+
+
+def get_version(resources=(CATALOG,)) -> str:
+    """
+    Version of data built from several resources, read with one cache lookup
+    """
+    keys = [get_generation_key(resource) for resource in resources]
+    found = get_cache().get_many(keys)
+    return '.'.join(
+        str(found[key]) if key in found else str(get_generation(resource))
+        for resource, key in zip(resources, keys)
+    )
+
+
+def bump_generation(resource: str = CATALOG) -> int:
+    """
+    Invalidates every entry versioned by the resource at once
+    """
+    cache = get_cache()
+    key = get_generation_key(resource)
+    try:
+        return cache.incr(key)
+    except ValueError:
+        get_generation(resource)
+        return cache.incr(key)
+
+
+def make_params_key(prefix: str, query_params, ignored=()) -> str:
+    """
+    Cache key of the request parameters that does not depend on their order
+    """
+    params = sorted(
+        (key, value)
+        for key, values in query_params.lists()
+        if key not in ignored
+        for value in values
+    )
+    digest = hashlib.md5(urlencode(params).encode()).hexdigest()
+    return f'{prefix}:{digest}'
+
+
+def make_versioned_key(prefix: str, query_params, ignored=(), resources=(CATALOG,)) -> str:
+    return make_params_key(f'{prefix}:{get_version(resources)}', query_params, ignored)
+
+
+def record_lookup(hit: bool) -> None:
+    cache = get_cache()
+    key = HITS_KEY if hit else MISSES_KEY
+    if not cache.add(key, 1, None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            cache.set(key, 1, None)
+
+
+def get_cache_stats() -> dict:
+    cache = get_cache()
+    hits = cache.get(HITS_KEY, 0)
+    misses = cache.get(MISSES_KEY, 0)
+    lookups = hits + misses
+    return {
+        **{f'generation:{resource}': get_generation(resource) for resource in RESOURCES},
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / lookups, 3) if lookups else None,
+    }
+
+
+def reset_cache_stats() -> None:
+    get_cache().delete_many([HITS_KEY, MISSES_KEY])
+
+
+class CachedResponseMixin(object):
+    """
+    Caches the serialized data of a list view until one of the resources
+    it shows changes
+    """
+    cache_timeout = None
+    cache_resources = (CATALOG,)
+
+    def get_cache_key(self, request) -> str:
+        return make_versioned_key(
+            f'shop_app:response:{request.path}',
+            request.query_params,
+            resources=self.cache_resources,
+        )
+
+    def list(self, request, *args, **kwargs):
+        cache = get_cache()
+        key = self.get_cache_key(request)
+        data = cache.get(key)
+        if data is not None:
+            record_lookup(hit=True)
+            return Response(data, headers={'X-Cache': 'HIT'})
+
+        record_lookup(hit=False)
+        response = super().list(request, *args, **kwargs)
+        if response.status_code == 200:
+            timeout = self.cache_timeout or settings.SHOP_RESPONSE_CACHE_TIMEOUT
+            cache.set(key, response.data, timeout)
+        response['X-Cache'] = 'MISS'
+        return response
+
+
+def catalog_etag(request, *args, **kwargs) -> str:
+    """
+    The catalog page changes with the product data and with the stock,
+    which the available filter and the product counts depend on
+    """
+    return make_versioned_key('catalog', request.GET, resources=(CATALOG, STOCK))
+
+
+def get_product_updated_at(request, pk, *args, **kwargs):
+    if not hasattr(request, '_product_updated_at'):
+        from .models import Product
+
+        request._product_updated_at = Product.objects\
+            .filter(pk=pk)\
+            .values_list('updated_at', flat=True)\
+            .first()
+    return request._product_updated_at
+
+
+def product_etag(request, pk, *args, **kwargs):
+    updated_at = get_product_updated_at(request, pk)
+    if updated_at is None:
+        return None
+    return f'product-{pk}-{int(updated_at.timestamp() * 1000000)}'
+
+
+def product_last_modified(request, pk, *args, **kwargs):
+    return get_product_updated_at(request, pk)
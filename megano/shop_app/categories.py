@@ -0,0 +1,102 @@
+import threading
+
+from .cache import CATEGORIES, get_generation
+from .models import Category, ImageCategory
+
+
+class CategoryTree(object):
+    """
+    Snapshot of the category tree taken by one query in the MPTT order,
+    where the descendants of a category follow it with a deeper level
+    """
+
+    def __init__(self, rows: list):
+        storage = ImageCategory._meta.get_field('src').storage
+        self.nodes = {}
+        self.order = []
+        for row in rows:
+            self.nodes[row['id']] = {
+                'id': row['id'],
+                'title': row['title'],
+                'parent': row['parent'],
+                'level': row['level'],
+                'image': None if row['image__id'] is None else {
+                    'src': storage.url(row['image__src']) if row['image__src'] else None,
+                    'alt': row['image__alt'],
+                },
+                'children': [],
+            }
+            self.order.append(row['id'])
+        for category_id in self.order:
+            parent = self.nodes[category_id]['parent']
+            if parent in self.nodes:
+                self.nodes[parent]['children'].append(category_id)
+        self.descendants = {}
+        for position, category_id in enumerate(self.order):
+            level = self.nodes[category_id]['level']
+            end = position + 1
+            while end < len(self.order) and self.nodes[self.order[end]]['level'] > level:
+                end += 1
+            self.descendants[category_id] = self.order[position:end]
+        self.menu = [self.get_menu_item(category_id) for category_id in self.order
+                     if self.nodes[category_id]['parent'] is None]
+
+    @classmethod
+    def build(cls) -> 'CategoryTree':
+        return cls(list(
+            Category.objects
+            .order_by('tree_id', 'lft')
+            .values('id', 'title', 'parent', 'level', 'image__id', 'image__src', 'image__alt')
+        ))
+
+    def get_menu_item(self, category_id: int) -> dict:
+        """
+        Root category with its subcategories in the shape of CategoriesSerializer
+        """
+        node = self.nodes[category_id]
+        return {
+            'id': node['id'],
+            'title': node['title'],
+            'image': node['image'],
+            'subcategories': [
+                {'id': child['id'],
+                 'title': child['title'],
+                 'image': child['image'], }
+                for child in map(self.nodes.get, node['children'])
+            ],
+        }
+
+    def get_descendant_ids(self, category_ids) -> list:
+        """
+        The categories and all of their descendants, unknown ids are skipped
+        """
+        descendant_ids = []
+        for category_id in category_ids:
+            descendant_ids.extend(self.descendants.get(int(category_id), ()))
+        return sorted(set(descendant_ids))
+
+    def get_parents(self) -> dict:
+        return {category_id: node['parent'] for category_id, node in self.nodes.items()}
+
+
+_snapshot = (None, None)
+_snapshot_lock = threading.Lock()
+
+
+def get_category_tree() -> CategoryTree:
+    """
+    Category tree held in the process memory, rebuilt when a signal has
+    bumped the category generation. With a shared cache the bumps of other
+    processes are seen on the next request, with a local one the tree is
+    rebuilt once its generation expires after SHOP_LOCAL_GENERATION_TIMEOUT
+    """
+    global _snapshot
+    generation = get_generation(CATEGORIES)
+    snapshot_generation, tree = _snapshot
+    if snapshot_generation != generation:
+        with _snapshot_lock:
+            snapshot_generation, tree = _snapshot
+            if snapshot_generation != generation:
+                tree = CategoryTree.build()
+                _snapshot = (generation, tree)
+    return tree
@@ -0,0 +1,141 @@
+import math
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db.models import Count, F, IntegerField, Max, Min, Q, QuerySet
+from django.db.models.functions import Cast, Floor
+
+from .categories import get_category_tree
+from .models import Product, Tag
+
+
+def get_tag_facets(product_ids: QuerySet) -> list:
+    return list(
+        Tag.objects
+        .filter(products__in=product_ids)
+        .values('id', 'name')
+        .annotate(count=Count('products', distinct=True))
+        .order_by('name', 'id')
+    )
+
+
+def get_category_facets(product_ids: QuerySet) -> list:
+    """
+    Product counts of every category, a category also counts the products
+    of its descendants
+    """
+    own_counts = dict(
+        Product.objects
+        .filter(id__in=product_ids)
+        .order_by()
+        .values_list('category')
+        .annotate(count=Count('id'))
+    )
+    if not own_counts:
+        return []
+    tree = get_category_tree()
+    categories = [tree.nodes[category_id] for category_id in tree.order]
+    parents = tree.get_parents()
+    counts = defaultdict(int)
+    for category_id, own_count in own_counts.items():
+        while category_id is not None:
+            counts[category_id] += own_count
+            category_id = parents.get(category_id)
+    return [
+        {'id': category['id'],
+         'title': category['title'],
+         'parent': category['parent'],
+         'count': counts[category['id']], }
+        for category in categories
+        if counts[category['id']]
+    ]
+
+
+def get_price_histogram(products: QuerySet, min_price, max_price, buckets: int) -> list:
+    if min_price is None:
+        return []
+    width = Decimal(math.ceil((max_price - min_price) / buckets) or 1)
+    rows = (
+        products
+        .order_by()
+        .annotate(bucket=Cast(Floor((F('price_p') - min_price) / width), IntegerField()))
+        .values_list('bucket')
+        .annotate(count=Count('id'))
+    )
+    counts = defaultdict(int)
+    for bucket, count in rows:
+        counts[min(bucket, buckets - 1)] += count
+    return [
+        {'from': min_price + width * bucket,
+         'to': min_price + width * (bucket + 1),
+         'count': counts[bucket], }
+        for bucket in range(buckets)
+        if counts[bucket]
+    ]
+
+
+# Filters left out when counting each facet, a facet counts its values over
+# the products matching the other filters so chosen values keep their counts
+FACET_EXCLUDED_FILTERS = {
+    'tags': ('tags',),
+    'categories': ('category',),
+    'price': ('minPrice', 'maxPrice'),
+    'freeDelivery': ('freeDelivery',),
+    'available': ('available',),
+}
+
+
+def get_facets(filterset, price_buckets: int = 10) -> dict:
+    """
+    Counts of the values of every catalog filter, each facet is computed with
+    one grouped query over the products matching all the other filters.
+    Facets whose own filters are not set share their aggregate query
+    """
+    active = filterset.get_active_filters()
+    product_ids = {}
+
+    def get_excluded(facet: str = None) -> frozenset:
+        return frozenset(active.intersection(FACET_EXCLUDED_FILTERS.get(facet, ())))
+
+    def get_product_ids(excluded: frozenset) -> QuerySet:
+        if excluded not in product_ids:
+            product_ids[excluded] = filterset\
+                .filter_queryset(filterset.queryset, exclude=excluded)\
+                .order_by()\
+                .values('id')
+        return product_ids[excluded]
+
+    aggregates = defaultdict(dict)
+    aggregates[get_excluded()]['total'] = Count('id')
+    aggregates[get_excluded('price')].update(min_price=Min('price_p'), max_price=Max('price_p'))
+    for facet, field in (('freeDelivery', 'free_delivery'), ('available', 'available')):
+        aggregates[get_excluded(facet)].update({
+            f'{field}_total': Count('id'),
+            field: Count('id', filter=Q(**{field: True})),
+        })
+    summary = {}
+    for excluded, expressions in aggregates.items():
+        summary.update(Product.objects.filter(id__in=get_product_ids(excluded)).aggregate(**expressions))
+    return {
+        'total': summary['total'],
+        'tags': get_tag_facets(get_product_ids(get_excluded('tags'))),
+        'categories': get_category_facets(get_product_ids(get_excluded('categories'))),
+        'price': {
+            'min': summary['min_price'],
+            'max': summary['max_price'],
+            'histogram': get_price_histogram(
+                Product.objects.filter(id__in=get_product_ids(get_excluded('price'))),
+                summary['min_price'],
+                summary['max_price'],
+                price_buckets,
+            ),
+        },
+        'freeDelivery': {
+            'true': summary['free_delivery'],
+            'false': summary['free_delivery_total'] - summary['free_delivery'],
+        },
+        'available': {
+            'true': summary['available'],
+            'false': summary['available_total'] - summary['available'],
+        },
+    }
@@ -1,15 +1,24 @@
+import datetime
+
 import django_filters
+from django_filters.constants import EMPTY_VALUES
 from django_filters.filterset import BaseFilterSet, FilterSetMetaclass
 from django_filters.rest_framework import filterset
 from django_filters import utils
 from django.db import models
-from .models import Product, Category
+from django.utils import timezone
+from .models import Product, Tag, Order
+from .categories import get_category_tree
+from .search import get_search_backend
 from rest_framework.filters import OrderingFilter
 
 
 class CustomOrderingFilter(OrderingFilter):
     ordering_param = 'sort'
     ordering_type = 'sortType'
+    ordering_aliases = {
+        'reviews': 'reviews_count',
+    }
 
     def get_ordering(self, request, queryset, view):
         """
@@ -20,7 +29,8 @@ class CustomOrderingFilter(OrderingFilter):
         """
         params = request.query_params.get(self.ordering_param)
         if params:
-            fields = [param.strip() for param in params.split(',')]
+            fields = [self.ordering_aliases.get(param.strip(), param.strip())
+                      for param in params.split(',')]
             ordering = self.remove_invalid_fields(queryset, fields, view, request)
             if ordering:
                 sort_type = request.query_params.get(self.ordering_type)
@@ -33,15 +43,20 @@ class CustomOrderingFilter(OrderingFilter):
 
 
 class CustomBaseFilterSet(BaseFilterSet):
-    def filter_queryset(self, queryset):
+    def filter_queryset(self, queryset, exclude=()):
         """
         Filter the queryset with the underlying form's `cleaned_data`. You must
         call `is_valid()` or `errors` before calling this method.
 
         This method should be overridden if additional filtering needs to be
         applied to the queryset before it is cached.
+
+        The filters named in exclude are skipped, the facets count the
+        values of a filter over the products matching the other filters.
         """
         for name, value in self.form.cleaned_data.items():
+            if name in exclude:
+                continue
             queryset = self.filters[name].filter(queryset, value)
             assert isinstance(
                 queryset, models.QuerySet
@@ -67,14 +82,14 @@ class NumberInFilter(django_filters.BaseInFilter, django_filters.NumberFilter):
 
 
 class ProductFilter(CustomDFFilterSet):
-    name = django_filters.CharFilter(field_name='title', lookup_expr='icontains')
+    name = django_filters.CharFilter(field_name='title', method='filter_name')
     minPrice = django_filters.NumberFilter(field_name='price_p', lookup_expr='gte')
     maxPrice = django_filters.NumberFilter(field_name='price_p', lookup_expr='lte')
     freeDelivery = django_filters.BooleanFilter(field_name='free_delivery')
     available = django_filters.BooleanFilter(field_name='available')
     # category = django_filters.NumberFilter(field_name='category__id')
-    category = NumberInFilter(field_name='category', lookup_expr='in')
-    tags = NumberInFilter(field_name='tags', lookup_expr='in')
+    category = NumberInFilter(field_name='category', method='filter_category')
+    tags = NumberInFilter(field_name='tags', method='filter_tags')
 
     class Meta:
         model = Product
@@ -88,6 +103,56 @@ class ProductFilter(CustomDFFilterSet):
             'tags'
         ]
 
+    def filter_name(self, queryset, name, value):
+        if not value:
+            return queryset
+        return get_search_backend().filter(queryset, value)
+
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.filter(id__in=Tag.products.through.objects.filter(tag__in=value).values('product'))
+
+    def filter_category(self, queryset, name, value):
+        if not value:
+            return queryset
+        return queryset.filter(**{f'{name}__in': get_category_tree().get_descendant_ids(value)})
+
+    def get_active_filters(self) -> set:
+        """
+        Names of the filters given a value, the filterset must be valid
+        """
+        return {
+            name for name, value in self.form.cleaned_data.items()
+            if value not in EMPTY_VALUES
+        }
+
+
+def start_of_day(day: datetime.date) -> datetime.datetime:
+    return timezone.make_aware(datetime.datetime.combine(day, datetime.time.min))
+
+
+class OrderFilter(django_filters.FilterSet):
+    """
+    Orders created from dateFrom to dateTo inclusive, the bounds are turned
+    into a datetime range so the lookup stays on the data_created index
+    """
+    dateFrom = django_filters.DateFilter(field_name='data_created', method='filter_date_from')
+    dateTo = django_filters.DateFilter(field_name='data_created', method='filter_date_to')
+
+    class Meta:
+        model = Order
+        fields = [
+            'dateFrom',
+            'dateTo',
+        ]
+
+    def filter_date_from(self, queryset, name, value):
+        return queryset.filter(**{f'{name}__gte': start_of_day(value)})
+
+    def filter_date_to(self, queryset, name, value):
+        return queryset.filter(**{f'{name}__lt': start_of_day(value + datetime.timedelta(days=1))})
+
 
 class CustomRFFilterSet(CustomDFFilterSet):
     pass
@@ -100,35 +165,32 @@ class CustomDjangoFilterBackend(django_filters.rest_framework.DjangoFilterBacken
     def get_filterset_kwargs(self, request, queryset, view):
         data = request.query_params
         new_data = {}
-        subcutegories_list = []
+        categories_list = []
         for key, value in data.items():
             if 'filter[' in key:
                 new_key = key[key.find('[') + 1:key.find(']')]
                 new_data[new_key] = value
             if 'category' in key:
-                subcutegories_qs = Category.objects.filter(parent=value)
-                # print(subcutegories_qs)
-                subcutegories_list.append(value)
-                for subcategory in subcutegories_qs:
-                    subcutegories_list.append(str(subcategory.id))
+                categories_list.append(value)
             else:
                 new_data[key] = value
 
         new_data['tags'] = ','.join(data.getlist('tags[]'))
-        # print(new_data)
-        # print(subcutegories_list)
-        new_data['category'] = ','.join(subcutegories_list)
+        new_data['category'] = ','.join(categories_list)
         return {
             "data": new_data,
             "queryset": queryset,
             "request": request,
         }
 
-    def filter_queryset(self, request, queryset, view):
+    def get_valid_filterset(self, request, queryset, view):
         filterset = self.get_filterset(request, queryset, view)
+        if filterset is not None and not filterset.is_valid() and self.raise_exception:
+            raise utils.translate_validation(filterset.errors)
+        return filterset
+
+    def filter_queryset(self, request, queryset, view):
+        filterset = self.get_valid_filterset(request, queryset, view)
         if filterset is None:
             return queryset
-
-        if not filterset.is_valid() and self.raise_exception:
-            raise utils.translate_validation(filterset.errors)
         return filterset.qs
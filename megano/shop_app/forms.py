@@ -22,20 +22,18 @@ class MySalesAdminForm(forms.ModelForm):
         return data_to
 
     def clean_status(self):
-        status = self.cleaned_data['status']
-        product = self.cleaned_data['product']
-        if status:
-            sales = Sale.objects.filter(product=product)
-            for sale in sales:
-                if sale.status:
-                    if sale.data_to < timezone.now():
-                        sale.status = False
-                        sale.save()
-                    else:
-                        raise ValidationError('During this period there is already a valid sale')
-        return status
-
-
-
-
-
+        """
+        The flag belongs to the sale scheduler, a sale is on while its
+        period lasts and periods of the sales of a product do not overlap
+        """
+        data_from = self.cleaned_data.get('data_from')
+        data_to = self.cleaned_data.get('data_to')
+        product = self.cleaned_data.get('product')
+        if data_from is None or data_to is None or product is None:
+            return self.cleaned_data['status']
+        overlapping = Sale.objects\
+            .filter(product=product, data_from__lte=data_to, data_to__gte=data_from)\
+            .exclude(pk=self.instance.pk)
+        if overlapping.exists():
+            raise ValidationError('During this period there is already a valid sale')
+        return data_from <= timezone.now() <= data_to
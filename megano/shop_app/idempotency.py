@@ -0,0 +1,109 @@
+import datetime
+import functools
+import hashlib
+import json
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Q
+from django.utils import timezone
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from .models import IdempotencyKey
+
+
+def get_request_hash(request) -> str:
+    body = json.dumps(request.data, cls=JSONEncoder, sort_keys=True)
+    return hashlib.sha256(f'{request.method} {request.path}\n{body}'.encode()).hexdigest()
+
+
+def get_scope(request):
+    """
+    Keys of different users and endpoints never collide, a client with
+    neither a user nor a session has no scope to keep keys in
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        owner = f'user:{user.pk}'
+    elif request.session.session_key:
+        owner = f'session:{request.session.session_key}'
+    else:
+        return None
+    return f'{request.method} {request.path} {owner}'
+
+
+def acquire_key(key: str, scope: str, request_hash: str):
+    """
+    Record of the key, created as pending when the key is new or expired.
+    A pending record whose lease has run out belonged to a request that
+    died, it is taken over by the first retry of the same request
+    """
+    now = timezone.now()
+    expires_at = now + datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL)
+    locked_until = now + datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_LEASE)
+    IdempotencyKey.objects.filter(scope=scope, key=key, expires_at__lte=now).delete()
+    try:
+        with transaction.atomic():
+            return IdempotencyKey.objects.create(
+                key=key,
+                scope=scope,
+                request_hash=request_hash,
+                expires_at=expires_at,
+                locked_until=locked_until,
+            ), True
+    except IntegrityError:
+        record = IdempotencyKey.objects.get(scope=scope, key=key)
+    if record.status_code is None and record.request_hash == request_hash:
+        # The lease is checked by the UPDATE itself, one retry takes it over
+        if IdempotencyKey.objects\
+                .filter(Q(locked_until__lte=now) | Q(locked_until=None), pk=record.pk, status_code=None)\
+                .update(locked_until=locked_until):
+            record.locked_until = locked_until
+            return record, True
+    return record, False
+
+
+def idempotent(view_method):
+    """
+    Replays the stored response for a retried request carrying the same
+    Idempotency-Key header instead of running the view again. A key reused
+    with another body answers 422, a key whose request still holds the
+    lease answers 409
+    """
+    @functools.wraps(view_method)
+    def wrapper(self, request, *args, **kwargs):
+        key = request.headers.get(settings.IDEMPOTENCY_KEY_HEADER)
+        scope = get_scope(request)
+        if not key or scope is None:
+            return view_method(self, request, *args, **kwargs)
+
+        request_hash = get_request_hash(request)
+        record, created = acquire_key(key[:255], scope, request_hash)
+        if not created:
+            if record.request_hash != request_hash:
+                return Response(data={'detail': 'Idempotency key reused with another request'}, status=422)
+            if record.status_code is None:
+                return Response(data={'detail': 'Request with this idempotency key is in progress'}, status=409)
+            return Response(data=record.response, status=record.status_code, headers={'Idempotent-Replayed': 'true'})
+
+        try:
+            response = view_method(self, request, *args, **kwargs)
+        except Exception:
+            record.delete()
+            raise
+        if response.status_code >= 500:
+            record.delete()
+            return response
+        record.status_code = response.status_code
+        record.response = json.loads(json.dumps(response.data, cls=JSONEncoder))
+        record.locked_until = None
+        record.save(update_fields=['status_code', 'response', 'locked_until'])
+        return response
+
+    return wrapper
+
+
+def purge_expired(now=None) -> int:
+    deleted, _ = IdempotencyKey.objects.filter(expires_at__lte=now or timezone.now()).delete()
+    return deleted
@@ -0,0 +1,134 @@
+import datetime
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Case, F, IntegerField, Sum, Value, When
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .cache import STOCK, bump_generation
+from .models import Order, Product, StockReservation
+
+
+class OutOfStock(Exception):
+    """
+    Some of the products do not have the requested number of units
+    """
+
+    def __init__(self, product_ids):
+        self.product_ids = sorted(product_ids)
+        super().__init__(f'Not enough units of the products {self.product_ids}')
+
+
+def units_case(counts: dict) -> Case:
+    return Case(
+        *[When(pk=product_id, then=Value(count)) for product_id, count in counts.items()],
+        default=Value(0),
+        output_field=IntegerField(),
+    )
+
+
+def take_stock(counts: dict) -> None:
+    """
+    Takes the units {product_id: count} off the stock with one conditional
+    UPDATE, nothing is taken when one of the products lacks units
+    """
+    counts = {int(product_id): count for product_id, count in counts.items() if count > 0}
+    if not counts:
+        return
+    units = units_case(counts)
+    try:
+        with transaction.atomic():
+            updated = Product.objects\
+                .filter(pk__in=counts, count_p__gte=units)\
+                .update(
+                    count_p=F('count_p') - units,
+                    available=Case(When(count_p__gt=units, then=F('available')), default=Value(False)),
+                    updated_at=Now(),
+                )
+            if updated < len(counts):
+                raise OutOfStock(counts)
+            transaction.on_commit(lambda: bump_generation(STOCK))
+    except OutOfStock:
+        stock = dict(Product.objects.filter(pk__in=counts).values_list('id', 'count_p'))
+        raise OutOfStock(
+            product_id for product_id, count in counts.items()
+            if stock.get(product_id, 0) < count
+        )
+
+
+def return_stock(counts: dict) -> None:
+    """
+    Puts the units back on the stock, a product that ran out is available again
+    """
+    counts = {int(product_id): count for product_id, count in counts.items() if count > 0}
+    if not counts:
+        return
+    Product.objects.filter(pk__in=counts).update(
+        count_p=F('count_p') + units_case(counts),
+        available=Case(When(count_p=0, then=Value(True)), default=F('available')),
+        updated_at=Now(),
+    )
+    transaction.on_commit(lambda: bump_generation(STOCK))
+
+
+def reserve_stock(order: Order, counts: dict, timeout: int = None) -> None:
+    """
+    Holds the units of the order until it is paid or the reservation expires
+    """
+    if timeout is None:
+        timeout = settings.STOCK_RESERVATION_TIMEOUT
+    expires_at = timezone.now() + datetime.timedelta(seconds=timeout)
+    with transaction.atomic():
+        take_stock(counts)
+        StockReservation.objects.bulk_create([
+            StockReservation(order=order, product_id=product_id, count=count, expires_at=expires_at)
+            for product_id, count in counts.items()
+            if count > 0
+        ])
+
+
+def commit_stock(order: Order) -> None:
+    """
+    Turns the held units of a paid order into sold ones, the units of
+    reservations that have already expired are taken off the stock again
+    """
+    reservations = StockReservation.objects.filter(order=order)
+    with transaction.atomic():
+        if reservations.filter(status=StockReservation.STATUS_HELD)\
+                .update(status=StockReservation.STATUS_COMMITTED):
+            return
+        released = reservations.filter(status=StockReservation.STATUS_RELEASED)
+        take_stock(dict(
+            released
+            .order_by()
+            .values_list('product')
+            .annotate(total=Sum('count'))
+        ))
+        released.update(status=StockReservation.STATUS_COMMITTED)
+
+
+def release_expired(now=None) -> int:
+    """
+    Returns the units of the unpaid expired reservations to the stock
+    """
+    now = now or timezone.now()
+    with transaction.atomic():
+        reservations = list(
+            StockReservation.objects
+            .select_for_update()
+            .filter(status=StockReservation.STATUS_HELD, expires_at__lte=now)
+            .values_list('id', 'product', 'count')
+        )
+        counts = {}
+        released = 0
+        for reservation_id, product_id, count in reservations:
+            # The status is checked by the UPDATE itself, a reservation
+            # committed or released by a concurrent run since the read is skipped
+            if StockReservation.objects\
+                    .filter(id=reservation_id, status=StockReservation.STATUS_HELD)\
+                    .update(status=StockReservation.STATUS_RELEASED):
+                counts[product_id] = counts.get(product_id, 0) + count
+                released += 1
+        return_stock(counts)
+    return released
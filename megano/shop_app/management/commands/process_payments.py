@@ -0,0 +1,31 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop_app.cache import is_local_cache
+from shop_app.payments import process_due_jobs
+
+
+class Command(BaseCommand):
+    help = 'Payment worker: charges the queued payment jobs through the PAYMENT_GATEWAY'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Process the due jobs and exit')
+        parser.add_argument('--batch', type=int, default=10, help='Jobs claimed at a time')
+        parser.add_argument('--interval', type=float, default=1.0, help='Seconds to sleep when the queue is empty')
+
+    def handle(self, *args, **options):
+        if is_local_cache():
+            self.stderr.write(self.style.WARNING(
+                'The shop cache is local to this process, the web processes see the changes '
+                f'within SHOP_LOCAL_GENERATION_TIMEOUT ({settings.SHOP_LOCAL_GENERATION_TIMEOUT} s)'
+            ))
+        while True:
+            jobs = process_due_jobs(options['batch'])
+            for job in jobs:
+                self.stdout.write(f'Payment of order {job.order_id}: {job.status} {job.error}'.rstrip())
+            if options['once']:
+                break
+            if not jobs:
+                time.sleep(options['interval'])
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.basket import purge_anonymous
+
+
+class Command(BaseCommand):
+    help = 'Deletes the baskets of anonymous sessions untouched for BASKET_ANONYMOUS_TTL'
+
+    def handle(self, *args, **options):
+        deleted = purge_anonymous()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} basket lines'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.idempotency import purge_expired
+
+
+class Command(BaseCommand):
+    help = 'Deletes the idempotency keys whose time to live has passed'
+
+    def handle(self, *args, **options):
+        deleted = purge_expired()
+        self.stdout.write(self.style.SUCCESS(f'Deleted {deleted} idempotency keys'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.stats import rebuild_review_stats
+
+
+class Command(BaseCommand):
+    help = 'Recalculates reviews_count, rating_sum and rating of every product'
+
+    def handle(self, *args, **options):
+        updated = rebuild_review_stats()
+        self.stdout.write(self.style.SUCCESS(f'Review stats rebuilt for {updated} products'))
@@ -0,0 +1,12 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.search import get_search_backend
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text index of the products'
+
+    def handle(self, *args, **options):
+        backend = get_search_backend()
+        backend.rebuild()
+        self.stdout.write(self.style.SUCCESS(f'Search index rebuilt by {type(backend).__name__}'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.inventory import release_expired
+
+
+class Command(BaseCommand):
+    help = 'Returns the units of the expired unpaid stock reservations to the stock, run it on a timer'
+
+    def handle(self, *args, **options):
+        released = release_expired()
+        self.stdout.write(self.style.SUCCESS(f'Released {released} stock reservations'))
@@ -0,0 +1,34 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from shop_app.cache import is_local_cache
+from shop_app.sales import sync_sale_statuses
+
+
+class Command(BaseCommand):
+    help = 'Sale scheduler: switches the sales on and off by their data_from and data_to'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='Synchronize the sales once and exit')
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=settings.SALE_SCHEDULER_INTERVAL,
+            help='Seconds between the runs',
+        )
+
+    def handle(self, *args, **options):
+        if is_local_cache():
+            self.stderr.write(self.style.WARNING(
+                'The shop cache is local to this process, the web processes see the changes '
+                f'within SHOP_LOCAL_GENERATION_TIMEOUT ({settings.SHOP_LOCAL_GENERATION_TIMEOUT} s)'
+            ))
+        while True:
+            activated, expired = sync_sale_statuses()
+            if activated or expired:
+                self.stdout.write(f'Sales activated: {activated}, expired: {expired}')
+            if options['once']:
+                break
+            time.sleep(options['interval'])
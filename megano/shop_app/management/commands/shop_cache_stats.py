@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from shop_app.cache import get_cache_stats, reset_cache_stats
+
+
+class Command(BaseCommand):
+    help = 'Shows hit and miss counters of the shop response cache'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true', help='Reset the counters after showing them')
+
+    def handle(self, *args, **options):
+        for name, value in get_cache_stats().items():
+            self.stdout.write(f'{name}: {value}')
+        if options['reset']:
+            reset_cache_stats()
+            self.stdout.write(self.style.SUCCESS('Counters reset'))
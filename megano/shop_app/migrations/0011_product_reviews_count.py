@@ -0,0 +1,40 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:43
+
+from django.db import migrations, models
+from django.db.models import Count, Sum
+
+
+def fill_review_stats(apps, schema_editor):
+    Product = apps.get_model('shop_app', 'Product')
+    Review = apps.get_model('shop_app', 'Review')
+    stats = Review.objects\
+        .order_by()\
+        .values('product')\
+        .annotate(count=Count('id'), rate_sum=Sum('rate'))
+    for item in stats:
+        Product.objects.filter(pk=item['product']).update(
+            reviews_count=item['count'],
+            rating_sum=item['rate_sum'],
+            rating=round(item['rate_sum'] / item['count'], 1),
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0010_sale'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='rating_sum',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='reviews_count',
+            field=models.PositiveIntegerField(default=0, editable=False),
+        ),
+        migrations.RunPython(fill_review_stats, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:05
+
+from django.db import migrations
+
+
+CREATE_SQL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS shop_app_product_fts USING fts5("
+    "title, description, tags, specifications, "
+    "tokenize = 'unicode61 remove_diacritics 2', prefix = '2 3')"
+)
+
+FILL_SQL = (
+    "INSERT INTO shop_app_product_fts (rowid, title, description, tags, specifications) "
+    "SELECT p.id, p.title, p.description, "
+    "(SELECT group_concat(t.name, ' ') FROM shop_app_tag t "
+    "JOIN shop_app_tag_products tp ON tp.tag_id = t.id "
+    "WHERE tp.product_id = p.id), "
+    "(SELECT group_concat(s.name || ' ' || s.value, ' ') FROM shop_app_specification s "
+    "JOIN shop_app_specification_products sp ON sp.specification_id = s.id "
+    "WHERE sp.product_id = p.id) "
+    "FROM shop_app_product p"
+)
+
+
+def create_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute(CREATE_SQL)
+    schema_editor.execute(FILL_SQL)
+
+
+def drop_fts_table(apps, schema_editor):
+    if schema_editor.connection.vendor != 'sqlite':
+        return
+    schema_editor.execute('DROP TABLE IF EXISTS shop_app_product_fts')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0011_product_reviews_count'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_fts_table, drop_fts_table),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:48
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0013_updated_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='product',
+            name='featured',
+            field=models.BooleanField(default=False),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:49
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0014_product_featured'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(db_index=True)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='shop_app.product')),
+            ],
+            options={
+                'ordering': ['-day', 'product'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='productsales',
+            constraint=models.UniqueConstraint(fields=('product', 'day'), name='unique_product_sales_day'),
+        ),
+    ]
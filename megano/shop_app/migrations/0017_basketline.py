@@ -0,0 +1,31 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:54
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0016_catalog_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BasketLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('owner', models.CharField(max_length=64)),
+                ('count', models.PositiveIntegerField(default=1)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='basket_lines', to='shop_app.product')),
+            ],
+            options={
+                'ordering': ['owner', 'id'],
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='basketline',
+            constraint=models.UniqueConstraint(fields=('owner', 'product'), name='unique_basket_line'),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 4.2.1 on 2026-10-18 15:58
+
+from django.db import migrations, models
+from django.db.models import F, OuterRef, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+
+def fill_order_totals(apps, schema_editor):
+    Order = apps.get_model('shop_app', 'Order')
+    ProductOptions = apps.get_model('shop_app', 'ProductOptions')
+    totals = ProductOptions.objects\
+        .filter(order=OuterRef('pk'))\
+        .order_by()\
+        .values('order')\
+        .annotate(total=Sum(F('price_option') * F('count_option')))\
+        .values('total')
+    Order.objects.update(total=Coalesce(Subquery(totals), 0, output_field=models.DecimalField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0018_stockreservation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='order',
+            name='total',
+            field=models.DecimalField(decimal_places=2, default=0, max_digits=10),
+        ),
+        migrations.RunPython(fill_order_totals, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0019_order_total'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['user', 'status', 'data_created'], name='order_user_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0022_paymentjob'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='review',
+            name='review_product_date_idx',
+        ),
+        migrations.AddIndex(
+            model_name='review',
+            index=models.Index(fields=['product', '-date_created', '-id'], name='review_product_date_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2.1 on 2026-10-18 16:26
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('shop_app', '0023_review_product_date_id_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='idempotencykey',
+            name='locked_until',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
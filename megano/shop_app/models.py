@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F
 from django.db.models.fields import related
 from mptt.models import MPTTModel, TreeForeignKey, TreeManager
 from django.utils import timezone
@@ -43,6 +44,27 @@ class ImageCategory(models.Model):
 class Product(models.Model):
     class Meta:
         ordering = ['title']
+        indexes = [
+            models.Index(fields=['title', 'id'], name='product_title_idx'),
+            models.Index(fields=['price_p', 'id'], name='product_price_idx'),
+            models.Index(fields=['rating', 'id'], name='product_rating_idx'),
+            models.Index(fields=['data_created', 'id'], name='product_created_idx'),
+            models.Index(fields=['reviews_count', 'id'], name='product_reviews_idx'),
+            models.Index(fields=['count_p', '-rating'], name='product_limited_idx'),
+            models.Index(fields=['-quantity_sold', 'rating'], name='product_popular_idx'),
+            models.Index(fields=['category', 'price_p'], name='product_category_price_idx'),
+            models.Index(fields=['available', 'price_p'], name='product_available_price_idx'),
+            models.Index(
+                fields=['price_p'],
+                name='product_free_delivery_idx',
+                condition=models.Q(free_delivery=True),
+            ),
+            models.Index(
+                fields=['rating'],
+                name='product_featured_idx',
+                condition=models.Q(featured=True),
+            ),
+        ]
 
     id = models.BigAutoField(auto_created=True, primary_key=True)
     category = models.ForeignKey(Category, on_delete=models.CASCADE, related_name='products')
@@ -54,7 +76,11 @@ class Product(models.Model):
     free_delivery = models.BooleanField(default=False)
     rating = models.FloatField(null=True)
     available = models.BooleanField(default=True)
+    featured = models.BooleanField(default=False)
     quantity_sold = models.SmallIntegerField(default=0)
+    reviews_count = models.PositiveIntegerField(default=0, editable=False)
+    rating_sum = models.PositiveIntegerField(default=0, editable=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.title} - {self.price_p}'
@@ -66,19 +92,12 @@ class Product(models.Model):
             return self.description
 
     def get_rating(self):
-        reviews = Review.objects.filter(product=self)
-        if reviews:
-            total_sum_rate = sum(review.rate for review in reviews)
-            total_count_rate = len(reviews)
-            self.rating = round(total_sum_rate/total_count_rate, 1)
-            self.save()
-            return self.rating
+        if self.reviews_count:
+            return round(self.rating_sum / self.reviews_count, 1)
         return None
 
     def get_available(self):
-        self.available = True if self.count_p != 0 else False
-        self.save()
-        return self.available
+        return self.available and self.count_p > 0
 
     def get_tags_dict(self):
         return [name for name in self.tags.name]
@@ -121,32 +140,27 @@ class Tag(models.Model):
 
 
 def validate_rate(rate: float):
-    if rate > 10:
+    if not 0 <= rate <= 10:
         raise ValidationError('Rate must be between 0 and 10')
 
 
 class Review(models.Model):
     class Meta:
         ordering = ['product', '-date_created']
+        indexes = [
+            models.Index(fields=['product', '-date_created', '-id'], name='review_product_date_idx'),
+        ]
 
     user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='reviews')
     product = models.ForeignKey(Product, related_name='reviews', on_delete=models.CASCADE)
     text = models.TextField()
     rate = models.SmallIntegerField(validators=[validate_rate])
     date_created = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.product.title} - {self.user.username}'
 
-    def save(
-        self, force_insert=False, force_update=False, using=None, update_fields=None
-    ):
-        super().save()
-        product = Product.objects\
-            .prefetch_related('reviews')\
-            .get(pk=self.product.id)
-        product.get_rating()
-
 
 class Specification(models.Model):
     class Meta:
@@ -181,9 +195,42 @@ def validate_status_type(string: str):
     #     raise ValidationError('Status type can be "accepted", "canceled" or "paid"')
 
 
+class OrderQuerySet(models.QuerySet):
+
+    def options_sum(self, expression):
+        """
+        Correlated subquery summing the expression over the lines of the order,
+        unlike a join with GROUP BY it keeps the ordering on the order indexes
+        """
+        return models.Subquery(
+            ProductOptions.objects
+            .filter(order=models.OuterRef('pk'))
+            .order_by()
+            .values('order')
+            .annotate(total=models.Sum(expression))
+            .values('total')
+        )
+
+    def with_total_cost(self):
+        """
+        Annotates the orders with the sum of their lines computed in SQL
+        """
+        return self.annotate(
+            options_total=self.options_sum(F('price_option') * F('count_option')),
+        )
+
+    def with_items_count(self):
+        return self.annotate(items_count=self.options_sum(F('count_option')))
+
+
 class Order(models.Model):
     class Meta:
         ordering = ['user', 'id']
+        indexes = [
+            models.Index(fields=['user', 'status', 'data_created'], name='order_user_status_created_idx'),
+        ]
+
+    objects = OrderQuerySet.as_manager()
 
     id = models.BigAutoField(auto_created=True, primary_key=True)
     city = models.CharField(max_length=100)
@@ -194,17 +241,33 @@ class Order(models.Model):
     payment_type = models.CharField(max_length=11, validators=[validate_payment_type])
     status = models.CharField(max_length=8, validators=[validate_status_type])
     products_in_order = models.ManyToManyField(Product, related_name='orders')
+    total = models.DecimalField(max_digits=10, decimal_places=2, default=0)
 
     def __str__(self):
         return str(self.id)
 
     def total_cost(self):
-        products = Product.objects.filter(orders=self)
-        return sum(product.price_p for product in products)
+        """
+        Total of the order lines, taken from the options_total annotation
+        when the order comes from with_total_cost()
+        """
+        if hasattr(self, 'options_total'):
+            return self.options_total or 0
+        return self.total
 
     def confirm_payment(self):
+        from .inventory import commit_stock
+        from .ranking import record_sales
+
+        with transaction.atomic():
+            paid = Order.objects\
+                .filter(pk=self.pk)\
+                .exclude(status='Paid')\
+                .update(status='Paid')
+            if paid:
+                commit_stock(self)
+                record_sales(self)
         self.status = 'Paid'
-        self.save()
         return self.status
 
 
@@ -219,6 +282,14 @@ class ProductOptions(models.Model):
 class Sale(models.Model):
     class Meta:
         ordering = ['status', '-data_to', 'id']
+        indexes = [
+            models.Index(fields=['product', 'status'], name='sale_product_status_idx'),
+            models.Index(
+                fields=['data_from'],
+                name='sale_active_from_idx',
+                condition=models.Q(status=True),
+            ),
+        ]
 
     id = models.BigAutoField(auto_created=True, primary_key=True)
     sale_price = models.DecimalField(blank=True, max_digits=8, decimal_places=2)
@@ -226,20 +297,145 @@ class Sale(models.Model):
     data_to = models.DateTimeField()
     product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='sales')
     status = models.BooleanField(default=False)
+    updated_at = models.DateTimeField(auto_now=True)
 
     def __str__(self):
         return f'{self.id}: {self.product.title} from {self.data_from} to {self.data_to}'
 
     def get_images(self):
-        product = Product.objects.get(id=self.product.id)
         return [
             {'src': image.src.url,
              'alt': image.alt, }
-            for image in product.images.all()
+            for image in self.product.images.all()
+        ]
+
+
+class ProductSales(models.Model):
+    """
+    Number of product units paid during a day, the source of the popularity windows
+    """
+    class Meta:
+        ordering = ['-day', 'product']
+        constraints = [
+            models.UniqueConstraint(fields=['product', 'day'], name='unique_product_sales_day'),
+        ]
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='daily_sales')
+    day = models.DateField(db_index=True)
+    count = models.PositiveIntegerField(default=0)
+
+    def __str__(self):
+        return f'{self.product_id}: {self.count} on {self.day}'
+
+
+class BasketLine(models.Model):
+    """
+    Line of a basket kept in its own row, the owner is a signed in user
+    or the basket token of an anonymous session
+    """
+    class Meta:
+        ordering = ['owner', 'id']
+        constraints = [
+            models.UniqueConstraint(fields=['owner', 'product'], name='unique_basket_line'),
+        ]
+
+    owner = models.CharField(max_length=64)
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='basket_lines')
+    count = models.PositiveIntegerField(default=1)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f'{self.owner}: {self.count} of {self.product_id}'
+
+
+class StockReservation(models.Model):
+    """
+    Units of a product held for an order, held units return to the stock
+    when the reservation expires and are sold when the order is paid
+    """
+    class Meta:
+        ordering = ['order', 'product']
+        indexes = [
+            models.Index(fields=['status', 'expires_at'], name='reservation_status_expiry_idx'),
+        ]
+
+    STATUS_HELD = 'held'
+    STATUS_COMMITTED = 'committed'
+    STATUS_RELEASED = 'released'
+    STATUS_CHOICES = [
+        (STATUS_HELD, 'Held'),
+        (STATUS_COMMITTED, 'Committed'),
+        (STATUS_RELEASED, 'Released'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='reservations')
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='reservations')
+    count = models.PositiveIntegerField()
+    status = models.CharField(max_length=9, choices=STATUS_CHOICES, default=STATUS_HELD)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField()
+
+    def __str__(self):
+        return f'{self.order_id}: {self.count} of {self.product_id} {self.status}'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Response of a request sent with an Idempotency-Key header, replayed
+    for the retries of the request until the key expires. A pending key is
+    leased to its request until locked_until, a retry takes it over after
+    """
+    class Meta:
+        ordering = ['created_at']
+        constraints = [
+            models.UniqueConstraint(fields=['scope', 'key'], name='unique_idempotency_key'),
         ]
 
+    key = models.CharField(max_length=255)
+    scope = models.CharField(max_length=255)
+    request_hash = models.CharField(max_length=64)
+    status_code = models.PositiveSmallIntegerField(null=True)
+    response = models.JSONField(null=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    expires_at = models.DateTimeField(db_index=True)
+    locked_until = models.DateTimeField(null=True)
 
+    def __str__(self):
+        return f'{self.scope}: {self.key}'
 
 
+class PaymentJob(models.Model):
+    """
+    Payment of an order waiting for the payment worker, the card is kept
+    only as the token issued by the gateway
+    """
+    class Meta:
+        ordering = ['created_at', 'id']
+        indexes = [
+            models.Index(fields=['status', 'available_at'], name='payment_job_queue_idx'),
+        ]
 
+    STATUS_QUEUED = 'queued'
+    STATUS_PROCESSING = 'processing'
+    STATUS_SUCCEEDED = 'succeeded'
+    STATUS_FAILED = 'failed'
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, 'Queued'),
+        (STATUS_PROCESSING, 'Processing'),
+        (STATUS_SUCCEEDED, 'Succeeded'),
+        (STATUS_FAILED, 'Failed'),
+    ]
+
+    order = models.ForeignKey(Order, on_delete=models.CASCADE, related_name='payment_jobs')
+    card_token = models.CharField(max_length=255)
+    amount = models.DecimalField(max_digits=10, decimal_places=2)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    attempts = models.PositiveSmallIntegerField(default=0)
+    available_at = models.DateTimeField(default=timezone.now)
+    transaction_id = models.CharField(max_length=255, blank=True)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
+    def __str__(self):
+        return f'{self.order_id}: {self.status}'
@@ -0,0 +1,177 @@
+import datetime
+import hashlib
+import uuid
+from functools import lru_cache
+
+from django.conf import settings
+from django.db.models import F, Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import Order, PaymentJob
+
+
+class PaymentDeclined(Exception):
+    """
+    The gateway refused the payment, retrying will not help
+    """
+
+
+class GatewayError(Exception):
+    """
+    The gateway could not be reached or failed, the payment is retried
+    """
+
+
+class BasePaymentGateway(object):
+    """
+    Interface of the payment gateways, the reference of a charge is its
+    idempotency key: the gateway charges a reference at most once
+    """
+
+    def tokenize(self, card: dict) -> str:
+        """
+        Token standing for the card in the later charge
+        """
+        raise NotImplementedError
+
+    def charge(self, token: str, amount, reference: str) -> str:
+        """
+        Charge the card and return the id of the gateway transaction, a
+        repeated reference returns the transaction of the first charge;
+        raises PaymentDeclined or GatewayError
+        """
+        raise NotImplementedError
+
+    def void(self, transaction_id: str, reference: str) -> None:
+        """
+        Cancel a charge whose order could not be paid, raises GatewayError
+        """
+        raise NotImplementedError
+
+
+class FakePaymentGateway(BasePaymentGateway):
+    """
+    Offline gateway for development and tests: a card number ending in 0 is
+    declined, one ending in 9 fails with a gateway error, others are charged.
+    The charges are kept by reference in memory
+    """
+
+    def __init__(self):
+        self.charges = {}
+
+    def tokenize(self, card: dict) -> str:
+        number = str(card['number'])
+        digest = hashlib.sha256(number.encode()).hexdigest()[:16]
+        return f'fake:{number[-1:]}:{digest}'
+
+    def charge(self, token: str, amount, reference: str) -> str:
+        if reference in self.charges:
+            return self.charges[reference]['transaction_id']
+        last_digit = token.split(':')[1]
+        if last_digit == '0':
+            raise PaymentDeclined('Card declined')
+        if last_digit == '9':
+            raise GatewayError('Gateway unavailable')
+        transaction_id = f'fake-{uuid.uuid4().hex}'
+        self.charges[reference] = {'transaction_id': transaction_id, 'amount': amount, 'voided': False}
+        return transaction_id
+
+    def void(self, transaction_id: str, reference: str) -> None:
+        self.charges[reference]['voided'] = True
+
+
+@lru_cache(maxsize=None)
+def get_payment_gateway() -> BasePaymentGateway:
+    return import_string(settings.PAYMENT_GATEWAY)()
+
+
+def enqueue_payment(order: Order, card: dict) -> PaymentJob:
+    """
+    Queues the payment of the order, a payment already waiting for the
+    worker or done is returned instead of queueing another one
+    """
+    job = order.payment_jobs\
+        .exclude(status=PaymentJob.STATUS_FAILED)\
+        .order_by('-id')\
+        .first()
+    if job is not None:
+        return job
+    return PaymentJob.objects.create(
+        order=order,
+        card_token=get_payment_gateway().tokenize(card),
+        amount=order.total,
+    )
+
+
+def claim_jobs(limit: int, now=None) -> list:
+    """
+    Jobs due for processing, a job is claimed by a conditional UPDATE so
+    parallel workers never take the same job. Jobs left processing by a
+    stopped worker are taken again after PAYMENT_JOB_TIMEOUT
+    """
+    now = now or timezone.now()
+    stale = now - datetime.timedelta(seconds=settings.PAYMENT_JOB_TIMEOUT)
+    due = Q(status=PaymentJob.STATUS_QUEUED, available_at__lte=now)\
+        | Q(status=PaymentJob.STATUS_PROCESSING, updated_at__lte=stale)
+    claimed = []
+    for job in PaymentJob.objects.filter(due).order_by('available_at', 'id')[:limit]:
+        if PaymentJob.objects\
+                .filter(due, pk=job.pk, updated_at=job.updated_at)\
+                .update(status=PaymentJob.STATUS_PROCESSING, attempts=F('attempts') + 1, updated_at=now):
+            job.refresh_from_db()
+            claimed.append(job)
+    return claimed
+
+
+def retry_later(job: PaymentJob, error: Exception) -> None:
+    """
+    Puts the job back in the queue with an exponential delay, the job
+    fails once it has used PAYMENT_MAX_ATTEMPTS
+    """
+    job.error = str(error)
+    if job.attempts >= settings.PAYMENT_MAX_ATTEMPTS:
+        job.status = PaymentJob.STATUS_FAILED
+    else:
+        job.status = PaymentJob.STATUS_QUEUED
+        job.available_at = timezone.now() + datetime.timedelta(
+            seconds=settings.PAYMENT_RETRY_DELAY * 2 ** (job.attempts - 1),
+        )
+
+
+def process_job(job: PaymentJob) -> PaymentJob:
+    """
+    Charges the card of a claimed job and marks the order paid. The charge
+    carries the reference of the job, so a job claimed again after a crash
+    is not charged twice. An error before the card is charged retries the
+    job, an order that cannot be paid after the charge voids it
+    """
+    gateway = get_payment_gateway()
+    reference = f'payment-job-{job.pk}'
+    try:
+        job.transaction_id = gateway.charge(job.card_token, job.amount, reference)
+    except PaymentDeclined as error:
+        job.status = PaymentJob.STATUS_FAILED
+        job.error = str(error)
+    except Exception as error:
+        retry_later(job, error)
+    else:
+        PaymentJob.objects.filter(pk=job.pk).update(transaction_id=job.transaction_id)
+        try:
+            job.order.confirm_payment()
+        except Exception as error:
+            job.status = PaymentJob.STATUS_FAILED
+            job.error = str(error)
+            try:
+                gateway.void(job.transaction_id, reference)
+            except Exception as void_error:
+                job.error = f'{error}; the charge was not voided: {void_error}'
+        else:
+            job.status = PaymentJob.STATUS_SUCCEEDED
+            job.error = ''
+    job.save()
+    return job
+
+
+def process_due_jobs(limit: int = 10) -> list:
+    return [process_job(job) for job in claim_jobs(limit)]
@@ -0,0 +1,75 @@
+from decimal import Decimal
+
+from django.conf import settings
+from django.db.models import Min, QuerySet
+from django.utils import timezone
+
+from .cache import CATALOG, SALES, get_cache, get_generation, get_version
+from .models import Product, Sale
+
+
+def active_sales(at=None) -> QuerySet:
+    """
+    Sales switched on and running at the given moment
+    """
+    at = at or timezone.now()
+    return Sale.objects.filter(status=True, data_from__lte=at, data_to__gte=at)
+
+
+def get_sale_prices() -> dict:
+    """
+    Lowest active sale price by product id, built with one query and kept
+    until the first of the running sales ends or the sales change;
+    the sale scheduler bumps the sales generation when it starts a sale
+    """
+    cache = get_cache()
+    key = f'shop_app:sale_prices:{get_generation(SALES)}'
+    sale_prices = cache.get(key)
+    if sale_prices is None:
+        now = timezone.now()
+        rows = list(
+            active_sales(now)
+            .order_by()
+            .values_list('product')
+            .annotate(price=Min('sale_price'), ends=Min('data_to'))
+        )
+        sale_prices = {product_id: price for product_id, price, _ in rows}
+        timeout = settings.SALE_PRICES_CACHE_TIMEOUT
+        if rows:
+            first_end = min(ends for _, _, ends in rows)
+            timeout = max(min(timeout, int((first_end - now).total_seconds())), 1)
+        cache.set(key, sale_prices, timeout)
+    return sale_prices
+
+
+def get_prices(product_ids) -> dict:
+    """
+    Effective prices of the products by id, resolved with one query for
+    the ids missing in the short-lived price cache
+    """
+    product_ids = {int(product_id) for product_id in product_ids}
+    if not product_ids:
+        return {}
+    cache = get_cache()
+    version = get_version((CATALOG, SALES))
+    keys = {product_id: f'shop_app:price:{version}:{product_id}' for product_id in product_ids}
+    cached = cache.get_many(keys.values())
+    prices = {
+        product_id: Decimal(cached[key])
+        for product_id, key in keys.items()
+        if key in cached
+    }
+    missing = product_ids - prices.keys()
+    if missing:
+        sale_prices = get_sale_prices()
+        rows = Product.objects\
+            .filter(pk__in=missing)\
+            .order_by()\
+            .values_list('id', 'price_p')
+        found = {product_id: sale_prices.get(product_id, price) for product_id, price in rows}
+        cache.set_many(
+            {keys[product_id]: str(price) for product_id, price in found.items()},
+            settings.BASKET_PRICE_CACHE_TIMEOUT,
+        )
+        prices.update(found)
+    return prices
@@ -0,0 +1,129 @@
+import datetime
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, F, FloatField, OuterRef, QuerySet, Subquery, Sum, Value, When
+from django.utils import timezone
+
+from .cache import CATALOG, SOLD, STOCK, bump_generation, get_cache, get_version
+from .models import Order, Product, ProductOptions, ProductSales
+
+
+def record_sales(order: Order) -> None:
+    """
+    Adds the units of a paid order to the sales counters of its products,
+    the rankings by sales are refreshed once the payment commits
+    """
+    counts = dict(
+        ProductOptions.objects
+        .filter(order=order)
+        .order_by()
+        .values_list('product')
+        .annotate(total=Sum('count_option'))
+    )
+    if not counts:
+        return
+    ordered = ProductOptions.objects\
+        .filter(order=order, product=OuterRef('pk'))\
+        .order_by()\
+        .values('product')\
+        .annotate(total=Sum('count_option'))\
+        .values('total')
+    Product.objects\
+        .filter(pk__in=counts)\
+        .update(quantity_sold=F('quantity_sold') + Subquery(ordered))
+
+    today = timezone.localdate()
+    for product_id, count in counts.items():
+        add_daily_sales(product_id, today, count)
+    transaction.on_commit(lambda: bump_generation(SOLD))
+
+
+def add_daily_sales(product_id: int, day, count: int) -> None:
+    """
+    Increments the counter of the day, the row is created when missing; a
+    row created meanwhile by a concurrent payment is incremented instead
+    """
+    rows = ProductSales.objects.filter(product=product_id, day=day)
+    if rows.update(count=F('count') + count):
+        return
+    try:
+        with transaction.atomic():
+            ProductSales.objects.create(product_id=product_id, day=day, count=count)
+    except IntegrityError:
+        rows.update(count=F('count') + count)
+
+
+def decayed_scores(window: int, half_life: float) -> QuerySet:
+    """
+    Units sold during the last days of the window by product, every day
+    weighs half as much as the day half_life days later; summed in SQL
+    with the weight of each day of the window
+    """
+    if window < 1:
+        raise ValueError('The window must be at least one day')
+    today = timezone.localdate()
+    weight = Case(
+        *[When(day=today - datetime.timedelta(days=age), then=Value(0.5 ** (age / half_life)))
+          for age in range(window)],
+        default=Value(0.0),
+        output_field=FloatField(),
+    )
+    return ProductSales.objects\
+        .filter(day__gt=today - datetime.timedelta(days=window))\
+        .order_by()\
+        .values('product')\
+        .annotate(score=Sum(F('count') * weight, output_field=FloatField()))
+
+
+def get_ranking(kind: str, compute, limit: int, resources=(CATALOG,)) -> list:
+    """
+    Ranked product ids kept in the cache until the resources they are
+    ranked by change, at most for RANKING_CACHE_TIMEOUT
+    """
+    key = f'shop_app:ranking:{get_version(resources)}:{kind}:{limit}'
+    return get_cache().get_or_set(key, compute, settings.RANKING_CACHE_TIMEOUT)
+
+
+def get_popular_ids(limit: int = 10, window: int = None) -> list:
+    if window is None:
+        return get_ranking(
+            'popular',
+            lambda: list(
+                Product.objects
+                .order_by('-quantity_sold', 'rating')
+                .values_list('id', flat=True)[:limit]
+            ),
+            limit,
+            resources=(CATALOG, SOLD),
+        )
+
+    def compute():
+        return list(
+            decayed_scores(window, settings.RANKING_HALF_LIFE_DAYS)
+            .order_by('-score', 'product')
+            .values_list('product', flat=True)[:limit]
+        )
+
+    return get_ranking(f'popular:{window}', compute, limit, resources=(CATALOG, SOLD))
+
+
+def get_limited_ids(limit: int = 10) -> list:
+    return get_ranking(
+        'limited',
+        lambda: list(
+            Product.objects
+            .order_by('count_p', '-rating')
+            .values_list('id', flat=True)[:limit]
+        ),
+        limit,
+        resources=(CATALOG, STOCK),
+    )
+
+
+def get_ranked_products(queryset, product_ids: list) -> list:
+    """
+    Products of the ranking in the order of their ranks
+    """
+    products = {product.id: product for product in queryset.filter(id__in=product_ids)}
+    return [products[product_id] for product_id in product_ids if product_id in products]
@@ -0,0 +1,28 @@
+from django.db import transaction
+from django.db.models import Q
+from django.db.models.functions import Now
+from django.utils import timezone
+
+from .cache import SALES, bump_generation
+from .models import Sale
+from .stats import touch_products
+
+
+def sync_sale_statuses(now=None) -> tuple:
+    """
+    Switches on the sales whose period has started and switches off the
+    ones whose period is over, each with one bulk UPDATE
+    """
+    now = now or timezone.now()
+    running = Q(data_from__lte=now, data_to__gte=now)
+    with transaction.atomic():
+        to_activate = Sale.objects.filter(running, status=False)
+        to_expire = Sale.objects.filter(~running, status=True)
+        product_ids = set(to_activate.values_list('product', flat=True))\
+            | set(to_expire.values_list('product', flat=True))
+        activated = to_activate.update(status=True, updated_at=Now())
+        expired = to_expire.update(status=False, updated_at=Now())
+        if activated or expired:
+            touch_products(product_ids)
+            transaction.on_commit(lambda: bump_generation(SALES))
+    return activated, expired
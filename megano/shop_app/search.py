@@ -0,0 +1,202 @@
+import re
+from functools import lru_cache
+from html import escape
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, QuerySet
+from django.db.models.expressions import RawSQL
+from django.utils.module_loading import import_string
+
+from .models import Product
+
+
+TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+# Control characters never found in product text, they mark the matches
+# until the text is escaped and the marks are turned into tags
+MATCH_START, MATCH_END = '\x02', '\x03'
+
+
+def split_query(query: str) -> list:
+    return TOKEN_RE.findall(str(query).lower())
+
+
+def mark_up(text) -> str:
+    """
+    Product text escaped for HTML with the marked matches in <b> tags
+    """
+    if text is None:
+        return ''
+    return escape(str(text)).replace(MATCH_START, '<b>').replace(MATCH_END, '</b>')
+
+
+class BaseSearchBackend(object):
+    """
+    Interface of the product search backends
+    """
+
+    def filter(self, queryset: QuerySet, query: str) -> QuerySet:
+        """
+        Narrow the product queryset down to the products matching the query
+        """
+        raise NotImplementedError
+
+    def search(self, query: str, limit: int = 20) -> list:
+        """
+        Ranked matches as dicts with id, rank, highlight and snippet keys,
+        the highlight and the snippet are escaped HTML with the matches in <b>
+        """
+        raise NotImplementedError
+
+    def index_products(self, product_ids) -> None:
+        pass
+
+    def remove_products(self, product_ids) -> None:
+        pass
+
+    def rebuild(self) -> None:
+        pass
+
+
+class SimpleSearchBackend(BaseSearchBackend):
+    """
+    Backend without an index, works on every database
+    """
+
+    def get_condition(self, query: str) -> Q:
+        condition = Q()
+        for token in split_query(query):
+            condition &= (
+                Q(title__icontains=token)
+                | Q(description__icontains=token)
+                | Q(tags__name__icontains=token)
+                | Q(specifications__value__icontains=token)
+            )
+        return condition
+
+    def filter(self, queryset, query):
+        if not split_query(query):
+            return queryset
+        ids = Product.objects.filter(self.get_condition(query)).values('id')
+        return queryset.filter(id__in=ids)
+
+    def search(self, query, limit=20):
+        if not split_query(query):
+            return []
+        products = Product.objects\
+            .filter(self.get_condition(query))\
+            .distinct()\
+            .values('id', 'title', 'description')[:limit]
+        return [
+            {'id': product['id'],
+             'rank': position,
+             'highlight': mark_up(product['title']),
+             'snippet': mark_up(product['description'][:100]), }
+            for position, product in enumerate(products)
+        ]
+
+
+class SQLiteFTS5SearchBackend(BaseSearchBackend):
+    """
+    Backend on the SQLite FTS5 virtual table created by the migrations,
+    the rowid of the table is the id of the product
+    """
+    table = 'shop_app_product_fts'
+    # bm25 weights of the title, description, tags and specifications columns
+    weights = (10.0, 1.0, 4.0, 2.0)
+
+    source_sql = (
+        "SELECT p.id, p.title, p.description, "
+        "(SELECT group_concat(t.name, ' ') FROM shop_app_tag t "
+        "JOIN shop_app_tag_products tp ON tp.tag_id = t.id "
+        "WHERE tp.product_id = p.id), "
+        "(SELECT group_concat(s.name || ' ' || s.value, ' ') FROM shop_app_specification s "
+        "JOIN shop_app_specification_products sp ON sp.specification_id = s.id "
+        "WHERE sp.product_id = p.id) "
+        "FROM shop_app_product p"
+    )
+
+    def get_match(self, query: str) -> str:
+        """
+        Every word of the query is matched as a prefix
+        """
+        return ' '.join('"{}"*'.format(token) for token in split_query(query))
+
+    def filter(self, queryset, query):
+        match = self.get_match(query)
+        if not match:
+            return queryset
+        return queryset.filter(id__in=RawSQL(
+            f'SELECT rowid FROM {self.table} WHERE {self.table} MATCH %s',
+            (match,),
+        ))
+
+    def search(self, query, limit=20):
+        match = self.get_match(query)
+        if not match:
+            return []
+        sql = (
+            f"SELECT rowid, bm25({self.table}, {', '.join(map(str, self.weights))}) AS rank, "
+            f"highlight({self.table}, 0, %s, %s), "
+            f"snippet({self.table}, 1, %s, %s, '...', 12) "
+            f"FROM {self.table} WHERE {self.table} MATCH %s ORDER BY rank LIMIT %s"
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(sql, (MATCH_START, MATCH_END, MATCH_START, MATCH_END, match, limit))
+            rows = cursor.fetchall()
+        return [
+            {'id': row[0],
+             'rank': row[1],
+             'highlight': mark_up(row[2]),
+             'snippet': mark_up(row[3]), }
+            for row in rows
+        ]
+
+    def index_products(self, product_ids):
+        product_ids = [int(product_id) for product_id in product_ids]
+        if not product_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})',
+                product_ids,
+            )
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description, tags, specifications) '
+                f'{self.source_sql} WHERE p.id IN ({placeholders})',
+                product_ids,
+            )
+
+    def remove_products(self, product_ids):
+        product_ids = [int(product_id) for product_id in product_ids]
+        if not product_ids:
+            return
+        placeholders = ', '.join(['%s'] * len(product_ids))
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f'DELETE FROM {self.table} WHERE rowid IN ({placeholders})',
+                product_ids,
+            )
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f'DELETE FROM {self.table}')
+            cursor.execute(
+                f'INSERT INTO {self.table} (rowid, title, description, tags, specifications) '
+                f'{self.source_sql}'
+            )
+
+
+@lru_cache(maxsize=None)
+def get_search_backend() -> BaseSearchBackend:
+    """
+    Backend from the PRODUCT_SEARCH_BACKEND setting, by default FTS5 on
+    SQLite and the index-free backend on other databases
+    """
+    path = getattr(settings, 'PRODUCT_SEARCH_BACKEND', None)
+    if path:
+        return import_string(path)()
+    if connection.vendor == 'sqlite':
+        return SQLiteFTS5SearchBackend()
+    return SimpleSearchBackend()
@@ -1,9 +1,17 @@
-from django.contrib.gis.gdal.raster import source
+import base64
+import json
+import math
+
+from rest_framework.exceptions import NotFound
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from django.core.exceptions import ValidationError
+from django.db.models import F, Q
+from django.urls import reverse
 from django.utils import timezone
 from django.conf import settings
 
+from .cache import CATALOG, STOCK, get_cache, make_versioned_key
 from .models import (
     Product,
     Category,
@@ -13,6 +21,7 @@ from .models import (
     Review,
     Specification,
     Order,
+    ProductOptions,
     Sale,
 )
 from rest_framework import serializers, pagination
@@ -85,7 +94,7 @@ class ProductSerializer(serializers.ModelSerializer):
     freeDelivery = serializers.BooleanField(source='free_delivery')
     images = ImageProductSerializer(many=True, read_only=True)
     tags = TagSerializer(many=True, read_only=True)
-    reviews = serializers.IntegerField(source='reviews.count')
+    reviews = serializers.IntegerField(source='reviews_count')
 
     class Meta:
         model = Product
@@ -105,6 +114,47 @@ class ProductSerializer(serializers.ModelSerializer):
         ]
 
 
+class BasketItemSerializer(ProductSerializer):
+    """
+    Product line of the basket, the products come with effective_price
+    set and the counts of the lines are passed in the context
+    """
+    price = serializers.DecimalField(source='effective_price', max_digits=8, decimal_places=2)
+    count = serializers.SerializerMethodField()
+
+    def get_count(self, product) -> int:
+        return self.context['counts'][product.id]
+
+
+class BasketTotalsSerializer(serializers.Serializer):
+    """
+    Totals over the lines of the basket, the price is rendered as the
+    prices of the lines
+    """
+    lines = serializers.IntegerField()
+    count = serializers.IntegerField()
+    price = serializers.DecimalField(max_digits=10, decimal_places=2)
+
+
+class BasketOperationSerializer(serializers.Serializer):
+    """
+    Change of one basket line in a batch: add or remove units, or set the count
+    """
+    id = serializers.IntegerField(min_value=1)
+    count = serializers.IntegerField(min_value=0, default=1)
+    op = serializers.ChoiceField(choices=['add', 'remove', 'set'], default='add')
+
+
+class OrderLineSerializer(serializers.Serializer):
+    """
+    Line of a new order, the count fits the count of the order options;
+    the line is priced by the shop, the price sent by the storefront is
+    not read
+    """
+    id = serializers.IntegerField()
+    count = serializers.IntegerField(min_value=1, max_value=32767)
+
+
 class CatalogPagination(pagination.PageNumberPagination):
     page_size = 20
     page_size_query_param = 'limit'
@@ -117,6 +167,151 @@ class CatalogPagination(pagination.PageNumberPagination):
         })
 
 
+class KeysetPagination(pagination.BasePagination):
+    """
+    Keyset pagination seeking on the sort key plus id, so a page costs the
+    same at any depth. The sort key is the ordering of the paginator or the
+    first ordering of the queryset; subclasses add their data to the cursor
+    """
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    cursor_query_param = 'cursor'
+    invalid_cursor_message = 'Invalid cursor'
+    ordering = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        self.set_ordering(self.ordering or self.get_queryset_ordering(queryset), queryset.model)
+
+        value, last_id = self.decode_cursor(request)
+        if last_id is not None:
+            queryset = queryset.filter(self.get_seek_filter(value, last_id))
+        queryset = queryset.order_by(*self.get_order_by())
+
+        results = list(queryset[:self.page_size + 1])
+        self.has_next = len(results) > self.page_size
+        self.page = results[:self.page_size]
+        return self.page
+
+    def get_page_size(self, request):
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        if page_size <= 0:
+            return self.page_size
+        return min(page_size, self.max_page_size)
+
+    @staticmethod
+    def get_queryset_ordering(queryset) -> str:
+        ordering = queryset.query.order_by or queryset.model._meta.ordering or ['pk']
+        return ordering[0]
+
+    def set_ordering(self, ordering: str, model) -> None:
+        self.descending = ordering.startswith('-')
+        self.field_name = ordering.lstrip('-')
+        if self.field_name == 'pk':
+            self.field_name = 'id'
+        self.field = model._meta.get_field(self.field_name)
+
+    def get_order_by(self):
+        key = F(self.field_name)
+        if self.descending:
+            key = key.desc(nulls_last=True) if self.field.null else key.desc()
+            return [key, F('id').desc()]
+        key = key.asc(nulls_first=True) if self.field.null else key.asc()
+        return [key, F('id').asc()]
+
+    def get_seek_filter(self, value, last_id):
+        field = self.field_name
+        if not self.field.null:
+            if self.descending:
+                return Q(**{f'{field}__lt': value}) | Q(**{field: value, 'id__lt': last_id})
+            return Q(**{f'{field}__gt': value}) | Q(**{field: value, 'id__gt': last_id})
+        if self.descending:
+            if value is None:
+                return Q(**{f'{field}__isnull': True, 'id__lt': last_id})
+            return (Q(**{f'{field}__lt': value})
+                    | Q(**{field: value, 'id__lt': last_id})
+                    | Q(**{f'{field}__isnull': True}))
+        if value is None:
+            return (Q(**{f'{field}__isnull': True, 'id__gt': last_id})
+                    | Q(**{f'{field}__isnull': False}))
+        return (Q(**{f'{field}__gt': value})
+                | Q(**{field: value, 'id__gt': last_id}))
+
+    def get_cursor_data(self, instance) -> dict:
+        value = getattr(instance, self.field_name)
+        return {'v': None if value is None else str(value), 'id': instance.id}
+
+    def encode_cursor(self, instance) -> str:
+        return base64.urlsafe_b64encode(json.dumps(self.get_cursor_data(instance)).encode()).decode()
+
+    def decode_cursor(self, request):
+        """
+        Sort key and id of the last row of the previous page, the whole
+        cursor is kept in self.cursor for the data of the subclasses
+        """
+        self.cursor = {}
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, None
+        try:
+            self.cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()))
+            value = None if self.cursor['v'] is None else self.field.to_python(self.cursor['v'])
+            if value is None and not self.field.null:
+                raise ValueError(self.cursor['v'])
+            return value, int(self.cursor['id'])
+        except (TypeError, ValueError, KeyError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+
+class CatalogCursorPagination(KeysetPagination):
+    """
+    Keyset pagination of the catalog on the active sort key plus id,
+    the number of the last page is taken from a cached count
+    """
+    count_ignored_params = ('cursor', 'currentPage', 'page', 'limit', 'sort', 'sortType')
+
+    def paginate_queryset(self, queryset, request, view=None):
+        page = super().paginate_queryset(queryset, request, view)
+        self.last_page = max(math.ceil(self.get_count(queryset, request) / self.page_size), 1)
+        return page
+
+    def get_paginated_response(self, data):
+        return Response({
+            'items': data,
+            'currentPage': self.current_page,
+            'lastPage': self.last_page,
+            'nextCursor': self.encode_cursor(self.page[-1]) if self.has_next else None,
+        })
+
+    def get_count(self, queryset, request):
+        return get_cache().get_or_set(
+            make_versioned_key(
+                'shop_app:catalog_count',
+                request.query_params,
+                self.count_ignored_params,
+                resources=(CATALOG, STOCK),
+            ),
+            queryset.count,
+            settings.CATALOG_COUNT_CACHE_TIMEOUT,
+        )
+
+    def get_cursor_data(self, instance) -> dict:
+        return dict(super().get_cursor_data(instance), p=self.current_page + 1)
+
+    def decode_cursor(self, request):
+        value, last_id = super().decode_cursor(request)
+        try:
+            self.current_page = int(self.cursor.get('p', 1))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        return value, last_id
+
+
 class ImageProductSaleSerializer(serializers.ModelSerializer):
     src = serializers.URLField(source='product.images.src.url')
     alt = serializers.CharField(source='product.images.alt')
@@ -130,13 +325,17 @@ class ImageProductSaleSerializer(serializers.ModelSerializer):
 
 
 class SaleSerializer(serializers.ModelSerializer):
-    id =serializers.IntegerField(source='product.id')
+    """
+    Sale card, reads only the columns of the sale card projection and
+    the prefetched images of the product
+    """
+    id = serializers.IntegerField(source='product.id')
     price = serializers.DecimalField(source='product.price_p', max_digits=8, decimal_places=2)
     salePrice = serializers.DecimalField(source='sale_price', max_digits=8, decimal_places=2)
     dateFrom = serializers.DateTimeField(source='data_from', format='%d.%m')
     dateTo = serializers.DateTimeField(source='data_to', format='%d.%m')
     title = serializers.CharField(source='product.title', max_length=255)
-    images = serializers.ListField(source='get_images')
+    images = ImageProductSerializer(source='product.images', many=True, read_only=True)
 
     class Meta:
         model = Sale
@@ -162,10 +361,11 @@ class TagDictSerializer(serializers.ModelSerializer):
 class ReviewsSerializer(serializers.ModelSerializer):
     author = serializers.CharField(source=('user.get_full_name'
                                            if 'user.get_full_name'
-                                           else 'user.username')
+                                           else 'user.username'),
+                                   read_only=True,
                                    )
-    email = serializers.EmailField(source='user.email')
-    date = serializers.DateTimeField(source='date_created', format='%Y-%m-%d %H:%M')
+    email = serializers.EmailField(source='user.email', read_only=True)
+    date = serializers.DateTimeField(source='date_created', format='%Y-%m-%d %H:%M', read_only=True)
 
     class Meta:
         model = Review
@@ -192,9 +392,24 @@ class ProductIdSerializer(ProductSerializer, serializers.ModelSerializer):
     price = serializers.DecimalField(source='price_p', max_digits=8, decimal_places=2)
     count = serializers.IntegerField(source='count_p')
     tags = TagSerializer(many=True, read_only=True)
-    reviews = ReviewsSerializer(many=True, read_only=True)
+    reviews = ReviewsSerializer(source='first_reviews', many=True, read_only=True)
+    reviewsCount = serializers.IntegerField(source='reviews_count', read_only=True)
+    reviewsNext = serializers.SerializerMethodField()
     specifications = SpecificationSerializer(many=True, read_only=True)
 
+    def get_reviewsNext(self, product):
+        """
+        Link to the reviews following the embedded ones, the product comes
+        with its first reviews prefetched into first_reviews
+        """
+        if not product.first_reviews or product.reviews_count <= len(product.first_reviews):
+            return None
+        url = reverse('shop_app:products_id_review', kwargs={'pk': product.pk})
+        request = self.context.get('request')
+        if request is not None:
+            url = request.build_absolute_uri(url)
+        return ReviewCursorPagination.get_link_after(url, product.first_reviews[-1])
+
     class Meta:
         model = Product
         fields = [
@@ -209,6 +424,8 @@ class ProductIdSerializer(ProductSerializer, serializers.ModelSerializer):
             'images',
             'tags',
             'reviews',
+            'reviewsCount',
+            'reviewsNext',
             'rating',
             'specifications',
         ]
@@ -217,10 +434,11 @@ class ProductIdSerializer(ProductSerializer, serializers.ModelSerializer):
 class ReviewSerializer(serializers.ModelSerializer):
     author = serializers.CharField(source=('user.get_full_name'
                                            if 'user.get_full_name'
-                                           else 'user.username')
+                                           else 'user.username'),
+                                   read_only=True,
                                    )
-    email = serializers.EmailField(source='user.email')
-    date = serializers.DateTimeField(source='date_created', format='%Y-%m-%d %H:%M')
+    email = serializers.EmailField(source='user.email', read_only=True)
+    date = serializers.DateTimeField(source='date_created', format='%Y-%m-%d %H:%M', read_only=True)
 
     class Meta:
         model = Review
@@ -267,16 +485,24 @@ class PaymentSerializer(serializers.Serializer):
 
 
 class ProductInOrderSerializer(serializers.ModelSerializer):
-    count = serializers.IntegerField(source='options__count_optional',)
-    price = serializers.DecimalField(source='options__price_option', max_digits=8, decimal_places=2)
-    date = serializers.DateTimeField(source='data_created')
-    freeDelivery = serializers.BooleanField(source='free_delivery')
-    images = ImageProductSerializer(many=True, read_only=True)
-    tags = TagSerializer(many=True, read_only=True)
-    reviews = serializers.IntegerField(source='reviews.count')
+    """
+    Ordered product with the price and the count of its order line
+    """
+    id = serializers.IntegerField(source='product.id')
+    category = serializers.IntegerField(source='product.category_id')
+    price = serializers.DecimalField(source='price_option', max_digits=8, decimal_places=2)
+    count = serializers.IntegerField(source='count_option')
+    date = serializers.DateTimeField(source='product.data_created')
+    title = serializers.CharField(source='product.title')
+    description = serializers.CharField(source='product.description')
+    freeDelivery = serializers.BooleanField(source='product.free_delivery')
+    images = ImageProductSerializer(source='product.images', many=True, read_only=True)
+    tags = TagSerializer(source='product.tags', many=True, read_only=True)
+    reviews = serializers.IntegerField(source='product.reviews_count')
+    rating = serializers.FloatField(source='product.rating')
 
     class Meta:
-        model = Product
+        model = ProductOptions
         fields = [
             'id',
             'category',
@@ -300,8 +526,8 @@ class OrderSerializer(serializers.ModelSerializer):
     phone = serializers.CharField(source='user.profile.phone')
     deliveryType = serializers.CharField(source='delivery_type')
     paymentType = serializers.CharField(source='payment_type')
-    totalCost = serializers.DecimalField(source='total_cost', max_digits=8, decimal_places=2)
-    products = ProductInOrderSerializer(many=True, read_only=True)
+    totalCost = serializers.DecimalField(source='total_cost', max_digits=10, decimal_places=2)
+    products = ProductInOrderSerializer(source='options', many=True, read_only=True)
 
     class Meta:
         model = Order
@@ -320,3 +546,74 @@ class OrderSerializer(serializers.ModelSerializer):
             "products"
         ]
 
+
+class OrderListSerializer(serializers.ModelSerializer):
+    """
+    Order of the history list without the products, the orders come
+    annotated by with_total_cost() and with_items_count()
+    """
+    createdAt = serializers.DateTimeField(source='data_created', format='%Y-%m-%d %H:%M')
+    deliveryType = serializers.CharField(source='delivery_type')
+    paymentType = serializers.CharField(source='payment_type')
+    totalCost = serializers.DecimalField(source='total_cost', max_digits=10, decimal_places=2)
+    itemsCount = serializers.IntegerField(source='items_count')
+
+    class Meta:
+        model = Order
+        fields = [
+            "id",
+            "createdAt",
+            "deliveryType",
+            "paymentType",
+            "totalCost",
+            "itemsCount",
+            "status",
+            "city",
+            "address",
+        ]
+
+
+class OrderCursorPagination(pagination.CursorPagination):
+    page_size = 20
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    ordering = ('-data_created', '-id')
+
+    def get_paginated_response(self, data):
+        return Response({
+            'items': data,
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+        })
+
+
+class ReviewCursorPagination(KeysetPagination):
+    """
+    Keyset pagination of the reviews of a product, newest first, seeking
+    on (date_created, id)
+    """
+    page_size = 10
+    ordering = '-date_created'
+
+    def get_paginated_response(self, data):
+        return Response({
+            'items': data,
+            'next': self.get_next_link(),
+        })
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        return replace_query_param(
+            self.request.build_absolute_uri(), self.cursor_query_param, self.encode_cursor(self.page[-1]),
+        )
+
+    @classmethod
+    def get_link_after(cls, url: str, review: Review) -> str:
+        """
+        Link to the reviews following the review, for the first reviews
+        embedded without a paginator
+        """
+        paginator = cls()
+        paginator.set_ordering(cls.ordering, Review)
+        return replace_query_param(url, cls.cursor_query_param, paginator.encode_cursor(review))
@@ -0,0 +1,151 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_save, post_delete, pre_delete, pre_save, m2m_changed
+from django.dispatch import receiver
+
+from .basket import get_basket_store
+from .cache import CATALOG, CATEGORIES, SALES, bump_generation
+from .models import (
+    Product,
+    Category,
+    ImageCategory,
+    ImageProduct,
+    Review,
+    Tag,
+    Specification,
+    Sale,
+)
+from .search import get_search_backend
+from .stats import apply_review_delta, rebuild_review_stats, touch_products
+
+
+@receiver(pre_save, sender=Review)
+def review_saving(sender, instance: Review, **kwargs):
+    instance._stats_product_id = None
+    if not instance._state.adding:
+        instance._stats_product_id = Review.objects\
+            .filter(pk=instance.pk)\
+            .values_list('product', flat=True)\
+            .first()
+
+
+@receiver(post_save, sender=Review)
+def review_saved(sender, instance: Review, created: bool, **kwargs):
+    if created:
+        apply_review_delta(instance.product_id, 1, instance.rate)
+    else:
+        # A review moved to another product leaves the stats of both
+        product_ids = {instance.product_id, getattr(instance, '_stats_product_id', None)} - {None}
+        rebuild_review_stats(Product.objects.filter(pk__in=product_ids))
+
+
+@receiver(post_delete, sender=Review)
+def review_deleted(sender, instance: Review, **kwargs):
+    apply_review_delta(instance.product_id, -1, -instance.rate)
+
+
+def related_products_changed(product_ids) -> None:
+    product_ids = list(product_ids)
+    get_search_backend().index_products(product_ids)
+    touch_products(product_ids)
+
+
+@receiver(post_save, sender=Product)
+def product_saved(sender, instance: Product, raw: bool = False, **kwargs):
+    if not raw:
+        get_search_backend().index_products([instance.pk])
+
+
+@receiver(post_delete, sender=Product)
+def product_deleted(sender, instance: Product, **kwargs):
+    get_search_backend().remove_products([instance.pk])
+
+
+@receiver(m2m_changed, sender=Tag.products.through)
+@receiver(m2m_changed, sender=Specification.products.through)
+def product_relations_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    if action == 'pre_clear' and not reverse:
+        instance._search_product_ids = list(instance.products.values_list('id', flat=True))
+    elif action == 'post_clear' and not reverse:
+        related_products_changed(getattr(instance, '_search_product_ids', []))
+    elif action in ('post_add', 'post_remove', 'post_clear'):
+        related_products_changed([instance.pk] if reverse else pk_set or [])
+
+
+@receiver(post_save, sender=Tag.products.through)
+@receiver(post_delete, sender=Tag.products.through)
+@receiver(post_save, sender=Specification.products.through)
+@receiver(post_delete, sender=Specification.products.through)
+def product_relation_row_changed(sender, instance, **kwargs):
+    related_products_changed([instance.product_id])
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_save, sender=Specification)
+def product_label_saved(sender, instance, created: bool, raw: bool = False, **kwargs):
+    if not created and not raw:
+        related_products_changed(instance.products.values_list('id', flat=True))
+
+
+@receiver(pre_delete, sender=Tag)
+@receiver(pre_delete, sender=Specification)
+def product_label_deleting(sender, instance, **kwargs):
+    instance._search_product_ids = list(instance.products.values_list('id', flat=True))
+
+
+@receiver(post_delete, sender=Tag)
+@receiver(post_delete, sender=Specification)
+def product_label_deleted(sender, instance, **kwargs):
+    related_products_changed(getattr(instance, '_search_product_ids', []))
+
+
+@receiver(post_save, sender=ImageProduct)
+@receiver(post_delete, sender=ImageProduct)
+@receiver(post_save, sender=Sale)
+@receiver(post_delete, sender=Sale)
+def product_part_changed(sender, instance, raw: bool = False, **kwargs):
+    if not raw:
+        touch_products([instance.product_id])
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_delete, sender=Product)
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ImageCategory)
+@receiver(post_delete, sender=ImageCategory)
+@receiver(post_save, sender=ImageProduct)
+@receiver(post_delete, sender=ImageProduct)
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+@receiver(post_save, sender=Tag.products.through)
+@receiver(post_delete, sender=Tag.products.through)
+@receiver(post_save, sender=Review)
+@receiver(post_delete, sender=Review)
+def shop_data_changed(sender, **kwargs):
+    bump_generation(CATALOG)
+
+
+@receiver(post_save, sender=Sale)
+@receiver(post_delete, sender=Sale)
+def sale_changed(sender, **kwargs):
+    bump_generation(SALES)
+
+
+@receiver(post_save, sender=Category)
+@receiver(post_delete, sender=Category)
+@receiver(post_save, sender=ImageCategory)
+@receiver(post_delete, sender=ImageCategory)
+def category_tree_changed(sender, **kwargs):
+    bump_generation(CATEGORIES)
+
+
+@receiver(m2m_changed, sender=Tag.products.through)
+def shop_relations_changed(sender, action: str, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_generation(CATALOG)
+
+
+@receiver(user_logged_in)
+def merge_anonymous_basket(sender, request, user, **kwargs):
+    if request is not None:
+        get_basket_store(request).merge_anonymous(user)
@@ -0,0 +1,77 @@
+from django.db.models import (
+    Case,
+    Count,
+    F,
+    FloatField,
+    OuterRef,
+    QuerySet,
+    Subquery,
+    Sum,
+    Value,
+    When,
+)
+from django.db.models.functions import Cast, Coalesce, Now, Round
+
+from .models import Product, Review
+
+
+def rating_expression(count_delta: int = 0, rate_delta: int = 0):
+    """
+    SQL expression for the average rate after applying the given deltas
+    to the stored reviews_count and rating_sum columns
+    """
+    return Case(
+        When(reviews_count__lte=-count_delta, then=Value(None)),
+        default=Round(
+            Cast(F('rating_sum') + rate_delta, FloatField()) / (F('reviews_count') + count_delta),
+            1,
+        ),
+        output_field=FloatField(),
+    )
+
+
+def apply_review_delta(product_id: int, count_delta: int, rate_delta: int) -> int:
+    """
+    Atomically shifts the review counters of a product by a single UPDATE
+    """
+    return Product.objects.filter(pk=product_id).update(
+        reviews_count=F('reviews_count') + count_delta,
+        rating_sum=F('rating_sum') + rate_delta,
+        rating=rating_expression(count_delta, rate_delta),
+        updated_at=Now(),
+    )
+
+
+def rebuild_review_stats(queryset: QuerySet = None) -> int:
+    """
+    Recalculates review counters of the products from the Review table
+    """
+    if queryset is None:
+        queryset = Product.objects.all()
+    reviews = Review.objects\
+        .filter(product=OuterRef('pk'))\
+        .order_by()\
+        .values('product')
+    updated = queryset.update(
+        reviews_count=Coalesce(
+            Subquery(reviews.annotate(total=Count('id')).values('total')),
+            0,
+        ),
+        rating_sum=Coalesce(
+            Subquery(reviews.annotate(total=Sum('rate')).values('total')),
+            0,
+        ),
+        updated_at=Now(),
+    )
+    queryset.update(rating=rating_expression())
+    return updated
+
+
+def touch_products(product_ids) -> int:
+    """
+    Moves the change timestamp of the products whose related data changed
+    """
+    product_ids = list(product_ids)
+    if not product_ids:
+        return 0
+    return Product.objects.filter(pk__in=product_ids).update(updated_at=Now())
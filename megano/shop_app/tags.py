@@ -0,0 +1,58 @@
+from collections import defaultdict
+
+from django.conf import settings
+from django.db.models import Count
+
+from .cache import CATALOG, get_cache, get_generation
+from .categories import get_category_tree
+from .models import Tag
+
+
+def build_tag_index() -> dict:
+    """
+    Tags of every category with the number of their products, a category
+    also counts the products of its descendants. The None key holds every
+    tag of the shop
+    """
+    tags = list(Tag.objects.order_by('name', 'id').values_list('id', 'name'))
+    own_counts = Tag.products.through.objects\
+        .order_by()\
+        .values_list('tag', 'product__category')\
+        .annotate(count=Count('product'))
+    parents = get_category_tree().get_parents()
+    counts = defaultdict(lambda: defaultdict(int))
+    for tag_id, category_id, count in own_counts:
+        counts[None][tag_id] += count
+        while category_id is not None:
+            counts[category_id][tag_id] += count
+            category_id = parents.get(category_id)
+    index = {None: [{'id': tag_id, 'name': name, 'count': counts[None][tag_id]} for tag_id, name in tags]}
+    for category_id, tag_counts in counts.items():
+        if category_id is not None:
+            index[category_id] = [
+                {'id': tag_id, 'name': name, 'count': tag_counts[tag_id]}
+                for tag_id, name in tags
+                if tag_id in tag_counts
+            ]
+    return index
+
+
+def get_tag_index() -> dict:
+    """
+    Index of the tags by category id kept in the shop cache until the
+    catalog changes, tags and their products bump the catalog generation
+    """
+    cache = get_cache()
+    key = f'shop_app:tag_index:{get_generation(CATALOG)}'
+    index = cache.get(key)
+    if index is None:
+        index = build_tag_index()
+        cache.set(key, index, settings.SHOP_RESPONSE_CACHE_TIMEOUT)
+    return index
+
+
+def get_category_tags(category_id=None) -> list:
+    """
+    Tags of the category and its descendants, every tag without a category
+    """
+    return get_tag_index().get(category_id, [])
@@ -1,3 +1,1535 @@
-from django.test import TestCase
+import datetime
+import io
+import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
 
-# Create your tests here.
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .basket import get_basket_store_class, purge_anonymous
+from .cache import CATEGORIES, get_cache, get_generation, get_generation_timeout
+from .categories import get_category_tree
+from .idempotency import get_request_hash
+from .inventory import release_expired
+from .payments import get_payment_gateway, process_due_jobs
+from .pricing import get_sale_prices
+from .ranking import decayed_scores, record_sales
+from .sales import sync_sale_statuses
+from .search import SQLiteFTS5SearchBackend, get_search_backend
+from .stats import rebuild_review_stats
+from .tags import get_tag_index
+from .models import (
+    BasketLine,
+    Category,
+    IdempotencyKey,
+    ImageProduct,
+    Order,
+    PaymentJob,
+    Product,
+    ProductOptions,
+    ProductSales,
+    Review,
+    Sale,
+    StockReservation,
+    Tag,
+)
+
+
+class QueryPlanTestCase(TestCase):
+    """
+    Every query of the read endpoints has to reach the large tables through
+    an index, the plans are taken with EXPLAIN QUERY PLAN on a seeded catalog
+    """
+    products_count = 3000
+    large_tables = (
+        'shop_app_product',
+        'shop_app_review',
+        'shop_app_sale',
+        'shop_app_tag_products',
+        'shop_app_specification_products',
+        'shop_app_order',
+        'shop_app_productoptions',
+    )
+    # A SCAN walks the whole table whether or not it goes through an index
+    full_scan_re = re.compile(r'^SCAN (\w+)(?: USING (?:COVERING )?INDEX (\w+))?')
+    # Aliases Django gives the tables of subqueries, "shop_app_tag_products" U0
+    alias_re = re.compile(r'"(\w+)" ([A-Z]\d+)\b')
+    partial_indexes = ('product_free_delivery_idx', 'product_featured_idx', 'sale_active_from_idx')
+
+    @classmethod
+    def setUpTestData(cls):
+        roots = [Category.objects.create(title=f'Root {i}') for i in range(5)]
+        categories = roots + [
+            Category.objects.create(title=f'Category {i}', parent=roots[i % 5])
+            for i in range(20)
+        ]
+        Product.objects.bulk_create([
+            Product(
+                category=categories[i % len(categories)],
+                price_p=Decimal(i % 997),
+                title=f'Product {i}',
+                rating=(i % 50) / 5,
+                count_p=i % 30,
+                quantity_sold=i % 40,
+                reviews_count=i % 9,
+                available=i % 7 != 0,
+                free_delivery=i % 3 == 0,
+                featured=i % 500 == 0,
+            )
+            for i in range(cls.products_count)
+        ])
+        product_ids = list(Product.objects.values_list('id', flat=True))
+        tags = [Tag.objects.create(name=f'Tag {i}') for i in range(30)]
+        Tag.products.through.objects.bulk_create([
+            Tag.products.through(tag_id=tags[i % len(tags)].id, product_id=product_id)
+            for i, product_id in enumerate(product_ids)
+        ])
+        user = User.objects.create(username='reviewer')
+        Review.objects.bulk_create([
+            Review(user=user, product_id=product_ids[i % len(product_ids)], text='Review', rate=i % 10)
+            for i in range(len(product_ids) * 2)
+        ])
+        now = timezone.now()
+        Sale.objects.bulk_create([
+            Sale(
+                product_id=product_id,
+                sale_price=Decimal(1),
+                data_from=now,
+                data_to=now + datetime.timedelta(days=3),
+                status=i % 2 == 0,
+            )
+            for i, product_id in enumerate(product_ids[::10])
+        ])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+        cls.root = roots[0]
+        cls.tag = tags[0]
+        cls.product_id = product_ids[len(product_ids) // 2]
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get_full_scans(self, sql: str, ordered=(), counted=False) -> list:
+        """
+        Plan lines walking a large table, with or without an index. A walk of
+        a partial index is bounded by its condition, a walk of an index from
+        ordered is bounded when the query takes a page with LIMIT and has no
+        correlated subquery run for every row it passes
+        """
+        aliases = dict((alias, table) for table, alias in self.alias_re.findall(sql))
+        with connection.cursor() as cursor:
+            cursor.execute(f'EXPLAIN QUERY PLAN {sql}')
+            plan = [row[-1] for row in cursor.fetchall()]
+        limited = ' LIMIT ' in sql and not any('CORRELATED' in line for line in plan)
+        scans = []
+        for line in plan:
+            match = self.full_scan_re.match(line)
+            if match is None:
+                continue
+            table, index = aliases.get(match.group(1), match.group(1)), match.group(2)
+            if table not in self.large_tables or index in self.partial_indexes:
+                continue
+            if limited and index in ordered:
+                continue
+            if counted and sql.startswith('SELECT COUNT(*)') and 'COVERING' in line:
+                continue
+            scans.append(f'{table}: {line}')
+        return scans
+
+    def assertNoFullScans(self, url: str, ordered=(), counted=False):
+        """
+        The ordered indexes and the page count of the pagination are the
+        only scans the url is allowed
+        """
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        for query in context.captured_queries:
+            if query['sql'].startswith('SELECT'):
+                scans = self.get_full_scans(query['sql'], ordered, counted)
+                self.assertEqual(scans, [], f'{url}: {query["sql"]}')
+
+    def test_catalog(self):
+        # The pages walk the index of their sort order until the LIMIT, the
+        # page numbers count every match through a covering index
+        urls = [
+            ('/api/catalog/', ['product_title_idx']),
+            ('/api/catalog/?sort=price_p&sortType=dec', ['product_price_idx']),
+            ('/api/catalog/?sort=rating', ['product_rating_idx']),
+            ('/api/catalog/?sort=data_created&sortType=dec', ['product_created_idx']),
+            ('/api/catalog/?sort=reviews', ['product_reviews_idx']),
+            (f'/api/catalog/?category={self.root.id}', []),
+            (f'/api/catalog/?tags[]={self.tag.id}', []),
+            ('/api/catalog/?filter[minPrice]=100&filter[maxPrice]=120', []),
+            ('/api/catalog/?filter[freeDelivery]=true', []),
+            ('/api/catalog/?filter[available]=true&sort=price_p', ['product_price_idx']),
+            ('/api/catalog/?cursor=&sort=rating&sortType=dec', ['product_rating_idx']),
+            ('/api/catalog/?filter[name]=product', []),
+            ('/api/catalog/facets/', []),
+        ]
+        for url, ordered in urls:
+            with self.subTest(url=url):
+                self.assertNoFullScans(url, ordered, counted=True)
+
+    def test_home_page(self):
+        # The tag index is built once for every catalog generation, the
+        # requests read it from the cache
+        get_tag_index()
+        urls = [
+            ('/api/categories/', [], False),
+            ('/api/banners/', [], False),
+            ('/api/products/popular/', ['product_popular_idx'], False),
+            ('/api/products/limited/', ['product_limited_idx'], False),
+            ('/api/sales/', [], True),
+            ('/api/tags/', [], False),
+            (f'/api/tags/?category={self.root.id}', [], False),
+        ]
+        for url, ordered, counted in urls:
+            with self.subTest(url=url):
+                self.assertNoFullScans(url, ordered, counted)
+
+    def test_product(self):
+        self.assertNoFullScans(f'/api/product/{self.product_id}/')
+        self.assertNoFullScans(f'/api/product/{self.product_id}/reviews?limit=1')
+
+    def test_order_history(self):
+        user = User.objects.get(username='reviewer')
+        for product_id in (self.product_id, self.product_id + 1):
+            order = Order.objects.create(user=user, status='accepted')
+            ProductOptions.objects.create(
+                order=order, product_id=product_id, id_product=product_id, price_option=Decimal(5), count_option=2,
+            )
+        self.client.force_login(user)
+        self.assertNoFullScans('/api/orders')
+        self.assertNoFullScans(f'/api/orders?dateFrom={timezone.localdate().isoformat()}')
+        self.assertNoFullScans(f'/api/order/{order.id}')
+
+
+class OrderCreateTestCase(TestCase):
+    """
+    Placing an order costs the same number of queries whatever the number of lines
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        Product.objects.bulk_create([
+            Product(category=category, price_p=Decimal(10 + i), title=f'Product {i}', count_p=100)
+            for i in range(30)
+        ])
+        cls.products = list(Product.objects.order_by('id'))
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        # The orders read the sale prices from the cache, as they do once warm
+        get_cache().clear()
+        get_sale_prices()
+
+    def place_order(self, products: list):
+        data = [
+            {'id': product.id, 'price': str(product.price_p), 'count': 2}
+            for product in products
+        ]
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.post('/api/orders', data, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        return Order.objects.get(pk=response.json()['orderId']), len(context.captured_queries)
+
+    def test_constant_queries(self):
+        order, single_queries = self.place_order(self.products[:1])
+        self.assertEqual(order.options.count(), 1)
+        order, bulk_queries = self.place_order(self.products)
+        self.assertEqual(bulk_queries, single_queries)
+        self.assertEqual(order.options.count(), 30)
+        self.assertEqual(order.products_in_order.count(), 30)
+
+    def test_unknown_product(self):
+        response = self.client.post(
+            '/api/orders',
+            [{'id': 0, 'price': '1', 'count': 1}],
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(Order.objects.exists())
+
+    def test_server_prices(self):
+        first, second = self.products[:2]
+        now = timezone.now()
+        Sale.objects.create(
+            product=second, sale_price=Decimal(5), data_from=now, data_to=now + datetime.timedelta(days=1), status=True,
+        )
+        get_cache().clear()
+        response = self.client.post(
+            '/api/orders',
+            [{'id': first.id, 'price': '0.01', 'count': 2}, {'id': second.id, 'count': 3}],
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 200)
+        order = Order.objects.get(pk=response.json()['orderId'])
+        self.assertEqual(order.total, first.price_p * 2 + Decimal(5) * 3)
+        self.assertEqual(
+            dict(order.options.values_list('id_product', 'price_option')),
+            {first.id: first.price_p, second.id: Decimal(5)},
+        )
+
+    def test_large_total(self):
+        product = Product.objects.create(
+            category=self.products[0].category, price_p=Decimal('999999.00'), title='Expensive', count_p=10,
+        )
+        response = self.client.post('/api/orders', [{'id': product.id, 'count': 5}], content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        order_id = response.json()['orderId']
+        response = self.client.get(f'/api/order/{order_id}')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Decimal(str(response.json()['totalCost'])), Decimal('4999995.00'))
+
+    def test_invalid_lines(self):
+        product = self.products[0]
+        for data in (
+            [{'id': product.id}],
+            [{'id': product.id, 'count': 'many'}],
+            [{'id': 'first', 'count': 1}],
+            {'id': product.id, 'count': 1},
+        ):
+            with self.subTest(data=data):
+                response = self.client.post('/api/orders', data, content_type='application/json')
+                self.assertEqual(response.status_code, 400)
+        self.assertFalse(Order.objects.exists())
+
+
+class StockReservationTestCase(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product', count_p=3)
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        get_payment_gateway().charges.clear()
+
+    def place_order(self, count: int):
+        return self.client.post(
+            '/api/orders',
+            [{'id': self.product.id, 'price': '10', 'count': count}],
+            content_type='application/json',
+        )
+
+    def pay(self, order_id: int, number: str = '12345678'):
+        response = self.client.post(
+            f'/api/payment/{order_id}',
+            {'number': number, 'name': 'Ivan Ivanov', 'month': '01', 'year': str(timezone.now().year - 1997), 'code': '123'},
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 202)
+        process_due_jobs()
+        return self.client.get(response.json()['statusUrl']).json()
+
+    def test_reserve_and_pay(self):
+        order_id = self.place_order(2).json()['orderId']
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.count_p, 1)
+        self.assertEqual(self.place_order(2).status_code, 409)
+        self.assertEqual(self.pay(order_id)['status'], 'Paid')
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.count_p, self.product.quantity_sold), (1, 2))
+        self.assertEqual(
+            StockReservation.objects.get(order=order_id).status,
+            StockReservation.STATUS_COMMITTED,
+        )
+
+    def test_expired_reservation(self):
+        order_id = self.place_order(3).json()['orderId']
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.count_p, self.product.available), (0, False))
+        self.assertEqual(release_expired(timezone.now() + datetime.timedelta(days=1)), 1)
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.count_p, self.product.available), (3, True))
+        self.assertEqual(self.pay(order_id)['status'], 'Paid')
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.count_p, 0)
+
+    def test_invalid_lines(self):
+        for count in (-1, 0, 'two', 40000):
+            with self.subTest(count=count):
+                self.assertEqual(self.place_order(count).status_code, 400)
+        self.assertFalse(Order.objects.exists())
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.count_p, 3)
+
+    def test_release_skips_committed(self):
+        order_id = self.place_order(2).json()['orderId']
+        committed = []
+
+        def commit_after_read(execute, sql, params, many, context):
+            result = execute(sql, params, many, context)
+            if not committed and sql.startswith('SELECT') and 'shop_app_stockreservation' in sql:
+                committed.append(
+                    StockReservation.objects.filter(order=order_id).update(status=StockReservation.STATUS_COMMITTED)
+                )
+            return result
+
+        with connection.execute_wrapper(commit_after_read):
+            released = release_expired(timezone.now() + datetime.timedelta(days=1))
+        self.assertEqual((committed, released), ([1], 0))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.count_p, 1)
+
+    def test_payment_retries(self):
+        order_id = self.place_order(1).json()['orderId']
+        status = self.pay(order_id, number='12345679')
+        self.assertEqual(status['status'], 'accepted')
+        self.assertEqual(status['payment']['status'], PaymentJob.STATUS_QUEUED)
+        PaymentJob.objects.update(available_at=timezone.now())
+        process_due_jobs()
+        self.assertEqual(PaymentJob.objects.get().attempts, 2)
+        PaymentJob.objects.update(attempts=settings.PAYMENT_MAX_ATTEMPTS - 1, available_at=timezone.now())
+        process_due_jobs()
+        self.assertEqual(PaymentJob.objects.get().status, PaymentJob.STATUS_FAILED)
+
+    def test_payment_declined(self):
+        order_id = self.place_order(1).json()['orderId']
+        status = self.pay(order_id, number='12345670')
+        self.assertEqual(status['status'], 'accepted')
+        self.assertEqual(status['payment']['status'], PaymentJob.STATUS_FAILED)
+        self.assertEqual(get_payment_gateway().charges, {})
+
+    def test_gateway_error(self):
+        order_id = self.place_order(1).json()['orderId']
+        status = self.pay(order_id, number='12345679')
+        job = PaymentJob.objects.get()
+        self.assertEqual((status['status'], job.status, job.transaction_id), ('accepted', PaymentJob.STATUS_QUEUED, ''))
+        self.assertEqual(job.error, 'Gateway unavailable')
+        self.assertGreater(job.available_at, timezone.now())
+        self.assertEqual(get_payment_gateway().charges, {})
+
+    def test_out_of_stock_after_charge(self):
+        order_id = self.place_order(3).json()['orderId']
+        release_expired(timezone.now() + datetime.timedelta(days=1))
+        self.assertEqual(self.place_order(2).status_code, 200)
+        status = self.pay(order_id)
+        job = PaymentJob.objects.get()
+        self.assertEqual((status['status'], job.status), ('accepted', PaymentJob.STATUS_FAILED))
+        self.assertIn(str(self.product.id), job.error)
+        charge = get_payment_gateway().charges[f'payment-job-{job.pk}']
+        self.assertEqual((charge['transaction_id'], charge['voided']), (job.transaction_id, True))
+        self.product.refresh_from_db()
+        self.assertEqual((self.product.count_p, self.product.quantity_sold), (1, 0))
+
+    def test_payment_of_other_orders(self):
+        card = {'number': '12345678', 'name': 'Ivan Ivanov', 'month': '01',
+                'year': str(timezone.now().year - 1997), 'code': '123'}
+        other = Order.objects.create(user=User.objects.create(username='other'), status='accepted')
+        paid = Order.objects.create(user=self.user, status='Paid', total=Decimal(10))
+        for order_id, status_code in ((10 ** 6, 404), (other.id, 404), (paid.id, 409)):
+            with self.subTest(order_id=order_id):
+                response = self.client.post(f'/api/payment/{order_id}', card, content_type='application/json')
+                self.assertEqual(response.status_code, status_code)
+        self.assertFalse(PaymentJob.objects.exists())
+
+    def test_claimed_again_after_charge(self):
+        order_id = self.place_order(1).json()['orderId']
+        self.assertEqual(self.pay(order_id)['status'], 'Paid')
+        job = PaymentJob.objects.get()
+        stale = timezone.now() - datetime.timedelta(seconds=settings.PAYMENT_JOB_TIMEOUT + 1)
+        PaymentJob.objects.update(status=PaymentJob.STATUS_PROCESSING, updated_at=stale)
+        process_due_jobs()
+        self.assertEqual(PaymentJob.objects.get().status, PaymentJob.STATUS_SUCCEEDED)
+        self.assertEqual(PaymentJob.objects.get().transaction_id, job.transaction_id)
+        self.assertEqual(len(get_payment_gateway().charges), 1)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.quantity_sold, 1)
+
+
+class StockConcurrencyTestCase(TransactionTestCase):
+    """
+    Concurrent checkouts against a file database in WAL mode never sell
+    more units than there are in stock. The rest of the suite keeps the
+    in-memory test database, this case alone runs on a migrated file
+    """
+    stock = 10
+    buyers = 24
+
+    @classmethod
+    def setUpClass(cls):
+        cls.database_dir = None
+        if connection.vendor == 'sqlite':
+            cls.database_dir = tempfile.mkdtemp()
+            cls.database_name = connection.settings_dict['NAME']
+            cls.database_connection = connection.connection
+            connection.connection = None
+            connection.settings_dict['NAME'] = os.path.join(cls.database_dir, 'stress.sqlite3')
+            call_command('migrate', verbosity=0, interactive=False, run_syncdb=True)
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        if cls.database_dir is not None:
+            connection.close()
+            connection.settings_dict['NAME'] = cls.database_name
+            connection.connection = cls.database_connection
+            shutil.rmtree(cls.database_dir)
+
+    def setUp(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+        category = Category.objects.create(title='Category')
+        self.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product', count_p=self.stock)
+        self.clients = []
+        for i in range(self.buyers):
+            client = Client()
+            client.force_login(User.objects.create(username=f'buyer{i}'))
+            self.clients.append(client)
+
+    def test_no_oversell(self):
+        if connection.vendor != 'sqlite' or connection.is_in_memory_db():
+            self.skipTest('Needs a file SQLite database')
+        statuses = []
+        barrier = threading.Barrier(self.buyers)
+
+        def checkout(client: Client):
+            try:
+                barrier.wait()
+                response = client.post(
+                    '/api/orders',
+                    [{'id': self.product.id, 'price': '10', 'count': 1}],
+                    content_type='application/json',
+                )
+                statuses.append(response.status_code)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=checkout, args=(client,)) for client in self.clients]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.product.refresh_from_db()
+        self.assertEqual(sorted(statuses), [200] * self.stock + [409] * (self.buyers - self.stock))
+        self.assertEqual(self.product.count_p, 0)
+        self.assertEqual(
+            sum(StockReservation.objects.values_list('count', flat=True)),
+            self.stock,
+        )
+
+
+class SalesQueryCountTestCase(TestCase):
+    """
+    A page of sale cards costs a fixed number of queries whatever its size
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        Product.objects.bulk_create([
+            Product(category=category, price_p=Decimal(100 + i), title=f'Product {i}')
+            for i in range(25)
+        ])
+        products = list(Product.objects.all())
+        ImageProduct.objects.bulk_create([
+            ImageProduct(product=product, src=f'product_{product.id}/images/{i}.jpg', alt=f'Image {i}')
+            for product in products
+            for i in range(2)
+        ])
+        now = timezone.now()
+        Sale.objects.bulk_create([
+            Sale(
+                product=product,
+                sale_price=Decimal(50),
+                data_from=now - datetime.timedelta(days=1),
+                data_to=now + datetime.timedelta(days=1),
+                status=True,
+            )
+            for product in products
+        ])
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_fixed_queries(self):
+        for limit in (5, 20):
+            with self.subTest(limit=limit), self.assertNumQueries(3):
+                response = self.client.get(f'/api/sales/?limit={limit}')
+            items = response.json()['items']
+            self.assertEqual(len(items), limit)
+            self.assertEqual(len(items[0]['images']), 2)
+
+
+class SaleSchedulerTestCase(TestCase):
+    """
+    The scheduler switches the sales by their periods and the shop prices
+    follow the running sales
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.products = [
+            Product.objects.create(category=category, price_p=Decimal(100), title=f'Product {i}', count_p=10)
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        get_cache().clear()
+        self.now = timezone.now()
+
+    def create_sale(self, product: Product, price: int, start: int, end: int, status: bool) -> Sale:
+        return Sale.objects.create(
+            product=product,
+            sale_price=Decimal(price),
+            data_from=self.now + datetime.timedelta(days=start),
+            data_to=self.now + datetime.timedelta(days=end),
+            status=status,
+        )
+
+    def test_sync_statuses(self):
+        first, second, third = self.products
+        started = self.create_sale(first, 80, -1, 1, False)
+        running = self.create_sale(second, 70, -1, 1, True)
+        upcoming = self.create_sale(third, 60, 1, 2, True)
+        over = self.create_sale(third, 50, -3, -2, True)
+        self.assertEqual(sync_sale_statuses(self.now), (1, 2))
+        self.assertEqual(
+            {sale.id: sale.status for sale in Sale.objects.all()},
+            {started.id: True, running.id: True, upcoming.id: False, over.id: False},
+        )
+        self.assertEqual(sync_sale_statuses(self.now), (0, 0))
+
+    def test_sale_prices(self):
+        first, second, third = self.products
+        self.create_sale(first, 80, -1, 1, True)
+        self.create_sale(first, 75, -1, 2, True)
+        self.create_sale(second, 70, 1, 2, False)
+        self.create_sale(third, 60, -1, 1, False)
+        self.assertEqual(get_sale_prices(), {first.id: Decimal(75)})
+        with self.captureOnCommitCallbacks(execute=True):
+            sync_sale_statuses()
+        self.assertEqual(get_sale_prices(), {first.id: Decimal(75), third.id: Decimal(60)})
+
+    def test_scheduler_process(self):
+        self.create_sale(self.products[0], 80, -1, 1, False)
+        self.assertEqual(self.client.get('/api/sales/').json()['items'], [])
+        self.assertEqual(get_sale_prices(), {})
+        # The scheduler runs in its own process, its bump never reaches this cache
+        Sale.objects.update(status=True)
+        self.assertEqual(self.client.get('/api/sales/')['X-Cache'], 'HIT')
+        later = time.time() + settings.SHOP_LOCAL_GENERATION_TIMEOUT + 1
+        with mock.patch('time.time', return_value=later):
+            response = self.client.get('/api/sales/')
+            self.assertEqual((response['X-Cache'], len(response.json()['items'])), ('MISS', 1))
+            self.assertEqual(get_sale_prices(), {self.products[0].id: Decimal(80)})
+        stderr = io.StringIO()
+        call_command('schedule_sales', '--once', stdout=io.StringIO(), stderr=stderr)
+        self.assertIn('SHOP_LOCAL_GENERATION_TIMEOUT', stderr.getvalue())
+
+    def test_basket_prices(self):
+        first, second, _ = self.products
+        self.create_sale(first, 80, -1, 1, True)
+        for product in (first, second):
+            self.client.post('/api/basket', {'id': product.id, 'count': 2}, content_type='application/json')
+        response = self.client.get('/api/basket?totals=1').json()
+        self.assertEqual(
+            {item['id']: float(item['price']) for item in response['items']},
+            {first.id: 80.0, second.id: 100.0},
+        )
+        self.assertEqual(float(response['totals']['price']), 360.0)
+
+
+class CategoryDescendantsTestCase(TestCase):
+    """
+    A category shows the products and the tags of every level of its subtree
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Category.objects.create(title='Root')
+        cls.child = Category.objects.create(title='Child', parent=cls.root)
+        cls.grandchild = Category.objects.create(title='Grandchild', parent=cls.child)
+        cls.other = Category.objects.create(title='Other')
+        cls.products = {
+            category: Product.objects.create(category=category, price_p=Decimal(10), title=f'{category.title} product')
+            for category in (cls.root, cls.child, cls.grandchild, cls.other)
+        }
+        cls.deep = Tag.objects.create(name='Deep')
+        cls.deep.products.add(cls.products[cls.grandchild])
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get_catalog_ids(self, category: Category) -> set:
+        response = self.client.get(f'/api/catalog/?category={category.id}')
+        self.assertEqual(response.status_code, 200)
+        return {item['id'] for item in response.json()['items']}
+
+    def test_catalog(self):
+        products = self.products
+        self.assertEqual(
+            self.get_catalog_ids(self.root),
+            {products[self.root].id, products[self.child].id, products[self.grandchild].id},
+        )
+        self.assertEqual(self.get_catalog_ids(self.child), {products[self.child].id, products[self.grandchild].id})
+        self.assertEqual(self.get_catalog_ids(self.grandchild), {products[self.grandchild].id})
+        self.assertEqual(self.get_catalog_ids(self.other), {products[self.other].id})
+
+    def test_tags(self):
+        for category, tags in ((self.root, [('Deep', 1)]), (self.child, [('Deep', 1)]), (self.other, [])):
+            with self.subTest(category=category.title):
+                response = self.client.get(f'/api/tags/?category={category.id}')
+                self.assertEqual([(tag['name'], tag['count']) for tag in response.json()], tags)
+
+
+class TagIndexTestCase(TestCase):
+    """
+    Tags of a category come from the tag index, counting the products of
+    the category and of its descendants
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.root = Category.objects.create(title='Root')
+        cls.child = Category.objects.create(title='Child', parent=cls.root)
+        cls.other = Category.objects.create(title='Other')
+        cls.red, cls.blue, cls.unused = [Tag.objects.create(name=name) for name in ('Red', 'Blue', 'Unused')]
+        cls.root_product = Product.objects.create(category=cls.root, price_p=Decimal(10), title='Root product')
+        cls.child_product = Product.objects.create(category=cls.child, price_p=Decimal(10), title='Child product')
+        cls.other_product = Product.objects.create(category=cls.other, price_p=Decimal(10), title='Other product')
+        cls.red.products.add(cls.root_product, cls.child_product)
+        cls.blue.products.add(cls.child_product)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get_tags(self, category=None) -> list:
+        url = '/api/tags/' if category is None else f'/api/tags/?category={category.id}'
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return [(tag['name'], tag['count']) for tag in response.json()]
+
+    def test_counts(self):
+        self.assertEqual(self.get_tags(), [('Blue', 1), ('Red', 2), ('Unused', 0)])
+        self.assertEqual(self.get_tags(self.root), [('Blue', 1), ('Red', 2)])
+        self.assertEqual(self.get_tags(self.child), [('Blue', 1), ('Red', 1)])
+        self.assertEqual(self.get_tags(self.other), [])
+
+    def test_keyed_lookup(self):
+        self.get_tags()
+        with self.assertNumQueries(0):
+            self.get_tags(self.child)
+
+    def test_invalidation(self):
+        self.get_tags(self.other)
+        self.unused.products.add(self.other_product)
+        self.assertEqual(self.get_tags(self.other), [('Unused', 1)])
+
+
+class ProductReviewsTestCase(TestCase):
+    """
+    The product detail embeds its newest reviews, the rest are read page
+    by page from the reviews endpoint
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product')
+        cls.user = User.objects.create(username='reviewer', email='reviewer@example.com')
+        cls.reviews = [
+            Review.objects.create(user=cls.user, product=cls.product, text=f'Review {i}', rate=4)
+            for i in range(12)
+        ]
+        # Equal dates are ordered by id
+        Review.objects.filter(pk__in=[review.pk for review in cls.reviews[:6]]).update(date_created=timezone.now())
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_detail_embeds_first_reviews(self):
+        with self.settings(PRODUCT_EMBEDDED_REVIEWS=5):
+            data = self.client.get(f'/api/product/{self.product.id}/').json()
+        self.assertEqual([review['text'] for review in data['reviews']], [f'Review {i}' for i in (5, 4, 3, 2, 1)])
+        self.assertEqual(data['reviewsCount'], 12)
+        rest = self.client.get(data['reviewsNext']).json()
+        self.assertEqual([review['text'] for review in rest['items']], [f'Review {i}' for i in (0, 11, 10, 9, 8, 7, 6)])
+        self.assertIsNone(rest['next'])
+
+    def test_keyset_pages(self):
+        texts = []
+        url = f'/api/product/{self.product.id}/reviews?limit=5'
+        while url:
+            with self.assertNumQueries(1):
+                data = self.client.get(url).json()
+            texts.extend(review['text'] for review in data['items'])
+            url = data['next']
+        self.assertEqual(len(texts), 12)
+        self.assertEqual(len(set(texts)), 12)
+
+    def test_create_returns_review_and_counters(self):
+        self.assertEqual(
+            self.client.post(f'/api/product/{self.product.id}/reviews', {'text': 'New', 'rate': 10}).status_code,
+            403,
+        )
+        self.client.force_login(self.user)
+        response = self.client.post(f'/api/product/{self.product.id}/reviews', {'text': 'New', 'rate': 10})
+        self.assertEqual(response.status_code, 201)
+        data = response.json()
+        self.assertEqual(data['review']['text'], 'New')
+        self.assertEqual(data['reviewsCount'], 13)
+        self.assertEqual(data['rating'], round(58 / 13, 1))
+
+    def test_invalid_review(self):
+        self.client.force_login(self.user)
+        for data in ({'rate': 4}, {'text': '', 'rate': 4}, {'text': 'New'}, {'text': 'New', 'rate': 'good'}, {'text': 'New', 'rate': 11}):
+            with self.subTest(data=data):
+                response = self.client.post(f'/api/product/{self.product.id}/reviews', data)
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(Review.objects.count(), 12)
+
+
+class ReviewStatsTestCase(TestCase):
+    """
+    The review counters of the products follow the reviews and can be
+    rebuilt from the Review table
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.first, cls.second = [
+            Product.objects.create(category=category, price_p=Decimal(10), title=f'Product {i}')
+            for i in range(2)
+        ]
+        cls.user = User.objects.create(username='reviewer')
+
+    def assertStats(self, product: Product, count: int, rate_sum: int, rating):
+        product.refresh_from_db()
+        self.assertEqual((product.reviews_count, product.rating_sum, product.rating), (count, rate_sum, rating))
+
+    def create_review(self, product: Product, rate: int) -> Review:
+        return Review.objects.create(user=self.user, product=product, text='Review', rate=rate)
+
+    def test_create_and_delete(self):
+        first = self.create_review(self.first, 4)
+        self.create_review(self.first, 7)
+        self.assertStats(self.first, 2, 11, 5.5)
+        first.delete()
+        self.assertStats(self.first, 1, 7, 7.0)
+        Review.objects.get().delete()
+        self.assertStats(self.first, 0, 0, None)
+
+    def test_edit(self):
+        review = self.create_review(self.first, 4)
+        self.create_review(self.first, 8)
+        review.rate = 10
+        review.save()
+        self.assertStats(self.first, 2, 18, 9.0)
+        review.product = self.second
+        review.save()
+        self.assertStats(self.first, 1, 8, 8.0)
+        self.assertStats(self.second, 1, 10, 10.0)
+
+    def test_rebuild(self):
+        self.create_review(self.first, 3)
+        self.create_review(self.first, 6)
+        self.create_review(self.second, 5)
+        Product.objects.update(reviews_count=40, rating_sum=100, rating=2.5)
+        self.assertEqual(rebuild_review_stats(Product.objects.filter(pk=self.first.pk)), 1)
+        self.assertStats(self.first, 2, 9, 4.5)
+        self.assertStats(self.second, 40, 100, 2.5)
+        call_command('rebuild_product_stats', stdout=io.StringIO())
+        self.assertStats(self.second, 1, 5, 5.0)
+
+    def test_rate_out_of_range(self):
+        self.client.force_login(self.user)
+        for rate in (-3, 11):
+            with self.subTest(rate=rate):
+                response = self.client.post(f'/api/product/{self.first.id}/reviews', {'text': 'Review', 'rate': rate})
+                self.assertEqual(response.status_code, 400)
+        self.assertStats(self.first, 0, 0, None)
+
+
+class CatalogCursorPaginationTestCase(TestCase):
+    """
+    Walking the catalog by cursor visits every product once in the order
+    of the sort, products without a rating come last
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        Product.objects.bulk_create([
+            Product(
+                category=category,
+                price_p=Decimal(10 + i % 4),
+                title=f'Product {i}',
+                rating=None if i % 5 == 0 else i % 3,
+            )
+            for i in range(23)
+        ])
+
+    def setUp(self):
+        get_cache().clear()
+
+    def walk(self, params: str) -> list:
+        data = self.client.get(f'/api/catalog/?cursor=&limit=5&{params}').json()
+        pages = [data]
+        while data['nextCursor']:
+            data = self.client.get(f'/api/catalog/?cursor={data["nextCursor"]}&limit=5&{params}').json()
+            pages.append(data)
+        return pages
+
+    def test_walk_sorted_pages(self):
+        for params, key, reverse in (
+            ('sort=price_p', 'price', False),
+            ('sort=price_p&sortType=dec', 'price', True),
+            ('sort=rating&sortType=dec', 'rating', True),
+        ):
+            with self.subTest(params=params):
+                pages = self.walk(params)
+                self.assertEqual([page['currentPage'] for page in pages], [1, 2, 3, 4, 5])
+                self.assertEqual({page['lastPage'] for page in pages}, {5})
+                items = [item for page in pages for item in page['items']]
+                self.assertEqual(len({item['id'] for item in items}), 23)
+                values = [item[key] for item in items]
+                known = [(float(value), item['id']) for value, item in zip(values, items) if value is not None]
+                self.assertEqual(known, sorted(known, reverse=reverse))
+                self.assertNotIn(None, values[:len(known)])
+
+    def test_invalid_cursor(self):
+        self.assertEqual(self.client.get('/api/catalog/?cursor=broken').status_code, 404)
+
+
+class ProductSearchTestCase(TestCase):
+    """
+    Both search backends answer with escaped highlights and a bounded limit
+    """
+    backends = (
+        'shop_app.search.SQLiteFTS5SearchBackend',
+        'shop_app.search.SimpleSearchBackend',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.products = [
+            Product.objects.create(
+                category=category,
+                price_p=Decimal(10),
+                title=f'<script>alert({i})</script> Phone {i}',
+                description='Phone & <i>case</i>',
+            )
+            for i in range(3)
+        ]
+
+    def search(self, backend: str, params: str):
+        get_search_backend.cache_clear()
+        self.addCleanup(get_search_backend.cache_clear)
+        with self.settings(PRODUCT_SEARCH_BACKEND=backend):
+            return self.client.get(f'/api/products/search/?q=phone&{params}')
+
+    def test_default_backend(self):
+        get_search_backend.cache_clear()
+        self.addCleanup(get_search_backend.cache_clear)
+        self.assertIsNone(settings.PRODUCT_SEARCH_BACKEND)
+        self.assertIsInstance(get_search_backend(), SQLiteFTS5SearchBackend)
+
+    def test_escaped_highlight(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend):
+                results = self.search(backend, 'limit=1').json()
+                self.assertEqual(len(results), 1)
+                self.assertNotIn('<script>', results[0]['highlight'])
+                self.assertIn('&lt;script&gt;', results[0]['highlight'])
+                self.assertNotIn('<i>', results[0]['snippet'])
+                self.assertIn('&amp;', results[0]['snippet'])
+        highlight = self.search(self.backends[0], '').json()[0]['highlight']
+        self.assertIn('&lt;/script&gt; <b>Phone</b>', highlight)
+
+    def test_limit(self):
+        for backend in self.backends:
+            with self.subTest(backend=backend):
+                self.assertEqual(len(self.search(backend, 'limit=-1').json()), 1)
+                self.assertEqual(len(self.search(backend, 'limit=0').json()), 1)
+                self.assertEqual(len(self.search(backend, 'limit=100').json()), 3)
+                self.assertEqual(self.search(backend, 'limit=many').status_code, 400)
+
+
+class CatalogFacetsTestCase(TestCase):
+    """
+    Each facet counts its values over the products matching the other
+    filters, so the values next to a chosen one keep their counts
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(title='Category')
+        cls.other = Category.objects.create(title='Other')
+        cls.red, cls.blue = Tag.objects.create(name='Red'), Tag.objects.create(name='Blue')
+        for i in range(6):
+            product = Product.objects.create(
+                category=cls.category if i < 4 else cls.other,
+                price_p=Decimal(10 * (i + 1)),
+                title=f'Product {i}',
+                free_delivery=i % 2 == 0,
+            )
+            (cls.red if i < 3 else cls.blue).products.add(product)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get_facets(self, params: str = '') -> dict:
+        response = self.client.get(f'/api/catalog/facets/?{params}')
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_chosen_values_keep_counts(self):
+        facets = self.get_facets(f'tags[]={self.red.id}&filter[freeDelivery]=true')
+        self.assertEqual(facets['total'], 2)
+        self.assertEqual(
+            {tag['name']: tag['count'] for tag in facets['tags']},
+            {'Red': 2, 'Blue': 1},
+        )
+        self.assertEqual(facets['freeDelivery'], {'true': 2, 'false': 1})
+        self.assertEqual({category['title']: category['count'] for category in facets['categories']}, {'Category': 2})
+
+    def test_price_range_ignores_price_filter(self):
+        facets = self.get_facets(f'category={self.category.id}&filter[minPrice]=25&filter[maxPrice]=35')
+        self.assertEqual(facets['total'], 1)
+        self.assertEqual((float(facets['price']['min']), float(facets['price']['max'])), (10, 40))
+        self.assertEqual(
+            {category['title']: category['count'] for category in facets['categories']},
+            {'Category': 1},
+        )
+
+    def test_unrelated_filter_shares_aggregate(self):
+        self.assertEqual(self.get_facets()['total'], 6)
+        get_cache().clear()
+        with CaptureQueriesContext(connection) as context:
+            self.get_facets()
+        unfiltered = len(context.captured_queries)
+        get_cache().clear()
+        with CaptureQueriesContext(connection) as context:
+            self.get_facets(f'tags[]={self.red.id}')
+        self.assertEqual(len(context.captured_queries), unfiltered)
+
+
+class ResponseCacheTestCase(TestCase):
+    """
+    Cached responses are dropped only by changes of the resources they show,
+    checkouts and payments leave the sale list cached
+    """
+    urls = ('/api/products/popular/', '/api/products/limited/', '/api/sales/', '/api/banners/')
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product', count_p=5)
+        now = timezone.now()
+        cls.sale = Sale.objects.create(
+            product=cls.product,
+            sale_price=Decimal(5),
+            data_from=now - datetime.timedelta(days=1),
+            data_to=now + datetime.timedelta(days=1),
+            status=True,
+        )
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        get_cache().clear()
+
+    def get_cache_statuses(self) -> dict:
+        return {url: self.client.get(url)['X-Cache'] for url in self.urls}
+
+    def test_checkout_and_payment(self):
+        self.get_cache_statuses()
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            order_id = self.client.post(
+                '/api/orders',
+                [{'id': self.product.id, 'price': '10', 'count': 1}],
+                content_type='application/json',
+            ).json()['orderId']
+            Order.objects.get(pk=order_id).confirm_payment()
+        self.assertEqual(self.get_cache_statuses(), {
+            '/api/products/popular/': 'MISS',
+            '/api/products/limited/': 'MISS',
+            '/api/sales/': 'HIT',
+            '/api/banners/': 'MISS',
+        })
+
+    def test_sold_out_banner(self):
+        Product.objects.filter(pk=self.product.pk).update(featured=True)
+        get_cache().clear()
+        self.assertEqual([item['count'] for item in self.client.get('/api/banners/').json()], [5])
+        self.client.force_login(self.user)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                '/api/orders', [{'id': self.product.id, 'count': 5}], content_type='application/json',
+            )
+        self.assertEqual(response.status_code, 200)
+        response = self.client.get('/api/banners/')
+        self.assertEqual((response['X-Cache'], response.json()), ('MISS', []))
+
+    def test_resource_changes(self):
+        self.get_cache_statuses()
+        self.sale.save()
+        self.assertEqual(self.get_cache_statuses(), {
+            '/api/products/popular/': 'HIT',
+            '/api/products/limited/': 'HIT',
+            '/api/sales/': 'MISS',
+            '/api/banners/': 'HIT',
+        })
+        self.product.save()
+        self.assertEqual(set(self.get_cache_statuses().values()), {'MISS'})
+
+
+class LocalCacheGenerationTestCase(TestCase):
+    """
+    Changes made by another process never reach a local cache, the data
+    versioned in it is rebuilt once its generation expires
+    """
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_local_generation_expires(self):
+        category = Category.objects.create(title='Category')
+        tree = get_category_tree()
+        generation = get_generation(CATEGORIES)
+        # Another process renames the category, its bump stays in its own cache
+        Category.objects.filter(pk=category.pk).update(title='Renamed')
+        self.assertIs(get_category_tree(), tree)
+        later = time.time() + settings.SHOP_LOCAL_GENERATION_TIMEOUT + 1
+        with mock.patch('time.time', return_value=later):
+            self.assertNotEqual(get_generation(CATEGORIES), generation)
+            self.assertEqual([item['title'] for item in get_category_tree().menu], ['Renamed'])
+
+    def test_shared_generation_kept(self):
+        self.assertEqual(get_generation_timeout(), settings.SHOP_LOCAL_GENERATION_TIMEOUT)
+        location = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, location)
+        shared = {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': location}
+        with self.settings(CACHES={'default': shared}):
+            self.assertIsNone(get_generation_timeout())
+
+
+class BannersTestCase(TestCase):
+    """
+    Banners show the available featured products first, the free slots go
+    to the best rated products
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+
+        def create(title, rating, featured=False, available=True):
+            return Product.objects.create(
+                category=category, price_p=Decimal(10), title=title, rating=rating,
+                featured=featured, available=available, count_p=1 if available else 0,
+            )
+
+        cls.featured = create('Featured', 1.0, featured=True)
+        cls.sold_out = create('Featured sold out', 9.0, featured=True, available=False)
+        cls.best = create('Best', 9.5)
+        cls.good = create('Good', 8.0)
+        cls.unrated = create('Unrated', None)
+        cls.hidden = create('Best sold out', 10.0, available=False)
+        cls.fair = create('Fair', 5.0)
+
+    def setUp(self):
+        get_cache().clear()
+
+    def test_order_and_limit(self):
+        with self.settings(BANNERS_LIMIT=3):
+            ids = [item['id'] for item in self.client.get('/api/banners/').json()]
+        self.assertEqual(ids, [self.featured.id, self.best.id, self.good.id])
+        get_cache().clear()
+        with self.settings(BANNERS_LIMIT=10):
+            ids = [item['id'] for item in self.client.get('/api/banners/').json()]
+        self.assertEqual(ids, [self.featured.id, self.best.id, self.good.id, self.fair.id, self.unrated.id])
+
+
+class ConditionalGetTestCase(TestCase):
+    """
+    Catalog and product pages answer 304 to a matching If-None-Match until
+    the data they show changes
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product', count_p=5)
+        cls.user = User.objects.create_user(username='reviewer', password='secret')
+
+    def setUp(self):
+        get_cache().clear()
+
+    def assertNotModified(self, url: str, etag: str):
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+    def assertModified(self, url: str, etag: str) -> str:
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        return response['ETag']
+
+    def test_catalog(self):
+        url = '/api/catalog/?sort=price_p'
+        etag = self.client.get(url)['ETag']
+        self.assertNotModified(url, etag)
+        self.assertEqual(self.client.get('/api/catalog/?sort=rating', HTTP_IF_NONE_MATCH=etag).status_code, 200)
+        now = timezone.now()
+        Sale.objects.create(
+            product=self.product,
+            sale_price=Decimal(5),
+            data_from=now,
+            data_to=now + datetime.timedelta(days=1),
+            status=True,
+        )
+        self.assertNotModified(url, etag)
+        self.product.title = 'Renamed'
+        self.product.save()
+        self.assertModified(url, etag)
+
+    def test_product(self):
+        url = f'/api/product/{self.product.id}/'
+        response = self.client.get(url)
+        etag = response['ETag']
+        self.assertNotModified(url, etag)
+        self.assertEqual(
+            self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified']).status_code,
+            304,
+        )
+        Review.objects.create(user=self.user, product=self.product, text='Review', rate=5)
+        self.assertModified(url, etag)
+
+
+class SalesRankingTestCase(TestCase):
+    """
+    Paid units are added to the daily counters and the popularity window
+    ranks the products by their decayed sales
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.products = [
+            Product.objects.create(category=category, price_p=Decimal(10), title=f'Product {i}', count_p=100)
+            for i in range(3)
+        ]
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        get_cache().clear()
+
+    def create_order(self, counts: dict) -> Order:
+        order = Order.objects.create(user=self.user, status='accepted')
+        ProductOptions.objects.bulk_create([
+            ProductOptions(
+                order=order, product=product, id_product=product.id, price_option=Decimal(10), count_option=count,
+            )
+            for product, count in counts.items()
+        ])
+        return order
+
+    def test_record_sales(self):
+        first, second = self.products[:2]
+        record_sales(self.create_order({first: 2}))
+        record_sales(self.create_order({first: 1, second: 4}))
+        today = timezone.localdate()
+        self.assertEqual(
+            dict(ProductSales.objects.filter(day=today).values_list('product', 'count')),
+            {first.id: 3, second.id: 4},
+        )
+        first.refresh_from_db()
+        self.assertEqual(first.quantity_sold, 3)
+
+    def test_payment_refreshes_ranking(self):
+        first, second, _ = self.products
+        record_sales(self.create_order({first: 1}))
+        ranked = [product['id'] for product in self.client.get('/api/products/popular/').json()]
+        self.assertEqual(ranked[0], first.id)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.create_order({second: 5}).confirm_payment()
+        ranked = [product['id'] for product in self.client.get('/api/products/popular/').json()]
+        self.assertEqual(ranked[:2], [second.id, first.id])
+
+    def test_decayed_window(self):
+        first, second, third = self.products
+        today = timezone.localdate()
+        ProductSales.objects.bulk_create([
+            ProductSales(product=first, day=today - datetime.timedelta(days=14), count=10),
+            ProductSales(product=first, day=today, count=1),
+            ProductSales(product=second, day=today - datetime.timedelta(days=1), count=3),
+            ProductSales(product=third, day=today - datetime.timedelta(days=40), count=100),
+        ])
+        scores = dict(decayed_scores(30, half_life=7).values_list('product', 'score'))
+        self.assertEqual(set(scores), {first.id, second.id})
+        self.assertAlmostEqual(scores[first.id], 1 + 10 * 0.25)
+        self.assertAlmostEqual(scores[second.id], 3 * 0.5 ** (1 / 7))
+        response = self.client.get('/api/products/popular/?window=30')
+        self.assertEqual([product['id'] for product in response.json()], [first.id, second.id])
+        with self.assertRaises(ValueError):
+            decayed_scores(0, half_life=7)
+
+    def test_invalid_window(self):
+        for window in ('0', '-3', 'week'):
+            with self.subTest(window=window):
+                self.assertEqual(self.client.get(f'/api/products/popular/?window={window}').status_code, 400)
+
+
+class BasketStoreTestCase(TestCase):
+    """
+    The basket behaves the same on every store, the stores outside the
+    session merge the anonymous basket into the basket of the user on sign in
+    """
+    stores = (
+        'shop_app.basket.SessionBasketStore',
+        'shop_app.basket.CacheBasketStore',
+        'shop_app.basket.DatabaseBasketStore',
+    )
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.first, cls.second = [
+            Product.objects.create(category=category, price_p=Decimal(price), title=f'Product {price}', count_p=10)
+            for price in (10, 20)
+        ]
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        get_cache().clear()
+        self.addCleanup(get_basket_store_class.cache_clear)
+
+    def use_store(self, store: str):
+        get_basket_store_class.cache_clear()
+        override = override_settings(BASKET_STORE=store)
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def get_counts(self) -> dict:
+        response = self.client.get('/api/basket')
+        self.assertEqual(response.status_code, 200)
+        return {item['id']: item['count'] for item in response.json()}
+
+    def add(self, product: Product, count: int):
+        response = self.client.post('/api/basket', {'id': product.id, 'count': count}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+
+    def test_lines(self):
+        for store in self.stores:
+            with self.subTest(store=store):
+                self.use_store(store)
+                self.client = Client()
+                self.add(self.first, 2)
+                self.add(self.first, 1)
+                self.add(self.second, 1)
+                self.assertEqual(self.get_counts(), {self.first.id: 3, self.second.id: 1})
+                self.client.delete('/api/basket', {'id': self.first.id, 'count': 1}, content_type='application/json')
+                self.client.delete('/api/basket', {'id': self.second.id, 'count': 1}, content_type='application/json')
+                self.assertEqual(self.get_counts(), {self.first.id: 2})
+
+    def test_totals(self):
+        self.add(self.first, 3)
+        self.add(self.second, 2)
+        data = self.client.get('/api/basket?totals=1').json()
+        self.assertEqual([item['price'] for item in data['items']], ['10.00', '20.00'])
+        self.assertEqual(data['totals'], {'lines': 2, 'count': 5, 'price': '70.00'})
+
+    def test_merge_on_sign_in(self):
+        for store in self.stores[1:]:
+            with self.subTest(store=store):
+                self.use_store(store)
+                self.client = Client()
+                self.client.force_login(self.user)
+                self.add(self.first, 1)
+                self.add(self.second, 1)
+                self.client.logout()
+                self.add(self.first, 2)
+                self.assertEqual(self.get_counts(), {self.first.id: 2})
+                self.client.login(username='buyer', password='secret')
+                self.assertEqual(self.get_counts(), {self.first.id: 3, self.second.id: 1})
+                self.client.logout()
+                self.assertEqual(self.get_counts(), {})
+                self.client.login(username='buyer', password='secret')
+                self.client.delete('/api/basket', {'id': self.first.id, 'count': 3}, content_type='application/json')
+                self.client.delete('/api/basket', {'id': self.second.id, 'count': 1}, content_type='application/json')
+        self.assertFalse(BasketLine.objects.exists())
+
+    def test_session_basket_moved(self):
+        self.use_store('shop_app.basket.DatabaseBasketStore')
+        session = self.client.session
+        session[settings.BASKET_SESSION_ID] = {str(self.first.id): {'count': 2, 'price': '10'}}
+        session.save()
+        self.assertEqual(self.get_counts(), {self.first.id: 2})
+        self.assertNotIn(settings.BASKET_SESSION_ID, self.client.session.keys())
+        self.assertEqual(BasketLine.objects.get().count, 2)
+        self.assertEqual(self.get_counts(), {self.first.id: 2})
+
+    def test_purge_anonymous(self):
+        now = timezone.now()
+        BasketLine.objects.bulk_create([
+            BasketLine(owner='anon:stale', product=self.first, count=1),
+            BasketLine(owner='anon:stale', product=self.second, count=1),
+            BasketLine(owner='anon:active', product=self.first, count=1),
+            BasketLine(owner='anon:active', product=self.second, count=1),
+            BasketLine(owner=f'user:{self.user.pk}', product=self.first, count=1),
+        ])
+        expired = now - datetime.timedelta(seconds=settings.BASKET_ANONYMOUS_TTL + 60)
+        BasketLine.objects.exclude(owner='anon:active', product=self.second).update(updated_at=expired)
+        self.assertEqual(purge_anonymous(now), 2)
+        self.assertEqual(
+            sorted(BasketLine.objects.values_list('owner', flat=True)),
+            ['anon:active', 'anon:active', f'user:{self.user.pk}'],
+        )
+
+
+class BasketPatchTestCase(TestCase):
+    """
+    A PATCH applies its whole batch of line changes or nothing
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        Product.objects.bulk_create([
+            Product(category=category, price_p=Decimal(10 + i), title=f'Product {i}', count_p=10)
+            for i in range(20)
+        ])
+        cls.products = list(Product.objects.order_by('id'))
+
+    def setUp(self):
+        get_cache().clear()
+
+    def patch(self, operations: list):
+        return self.client.patch('/api/basket?totals=1', operations, content_type='application/json')
+
+    def get_counts(self) -> dict:
+        return {item['id']: item['count'] for item in self.client.get('/api/basket').json()}
+
+    def test_operations(self):
+        first, second, third = self.products[:3]
+        response = self.patch([
+            {'id': first.id, 'count': 2},
+            {'id': second.id, 'count': 5},
+            {'id': first.id},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['totals'], {'lines': 2, 'count': 8, 'price': '85.00'})
+        response = self.patch([
+            {'id': first.id, 'count': 1, 'op': 'set'},
+            {'id': second.id, 'count': 5, 'op': 'remove'},
+            {'id': third.id, 'count': 4, 'op': 'add'},
+        ])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_counts(), {first.id: 1, third.id: 4})
+        self.assertEqual(
+            dict(BasketLine.objects.values_list('product', 'count')),
+            {first.id: 1, third.id: 4},
+        )
+
+    def test_upsert_queries(self):
+        self.patch([{'id': self.products[0].id}])
+
+        def count_queries(products):
+            with CaptureQueriesContext(connection) as context:
+                response = self.patch([{'id': product.id, 'count': 3, 'op': 'set'} for product in products])
+            self.assertEqual(response.status_code, 200)
+            return len(context.captured_queries)
+
+        few = count_queries(self.products[:2])
+        many = count_queries(self.products)
+        self.assertEqual(many, few)
+        self.assertEqual(set(BasketLine.objects.values_list('count', flat=True)), {3})
+        self.assertEqual(BasketLine.objects.count(), len(self.products))
+
+    def test_rejected(self):
+        first = self.products[0]
+        self.patch([{'id': first.id, 'count': 2}])
+        response = self.patch([{'id': first.id, 'count': 1}, {'id': 10 ** 6, 'count': 1}])
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.json(), {'missing': [10 ** 6]})
+        for operations in ([{'id': first.id, 'op': 'double'}], [{'id': first.id, 'count': -1}], {'id': first.id}):
+            with self.subTest(operations=operations):
+                self.assertEqual(self.patch(operations).status_code, 400)
+        self.assertEqual(self.get_counts(), {first.id: 2})
+
+
+class IdempotencyKeyTestCase(TestCase):
+    """
+    A retried order with the same Idempotency-Key is placed once
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        category = Category.objects.create(title='Category')
+        cls.product = Product.objects.create(category=category, price_p=Decimal(10), title='Product', count_p=10)
+        cls.user = User.objects.create_user(username='buyer', password='secret')
+
+    def setUp(self):
+        self.client.force_login(self.user)
+        self.data = [{'id': self.product.id, 'count': 1}]
+
+    def place_order(self, data: list, key: str = 'order-1'):
+        return self.client.post(
+            '/api/orders', data, content_type='application/json', HTTP_IDEMPOTENCY_KEY=key,
+        )
+
+    def create_pending(self, locked_until) -> IdempotencyKey:
+        request = SimpleNamespace(method='POST', path='/api/orders', data=self.data)
+        return IdempotencyKey.objects.create(
+            key='order-1',
+            scope=f'POST /api/orders user:{self.user.pk}',
+            request_hash=get_request_hash(request),
+            expires_at=timezone.now() + datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_TTL),
+            locked_until=locked_until,
+        )
+
+    def test_replay(self):
+        first = self.place_order(self.data)
+        second = self.place_order(self.data)
+        self.assertEqual((first.status_code, second.status_code), (200, 200))
+        self.assertEqual(second.json(), first.json())
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(Order.objects.count(), 1)
+        self.assertIsNone(IdempotencyKey.objects.get().locked_until)
+        self.assertEqual(self.place_order(self.data, key='order-2').status_code, 200)
+        self.assertEqual(Order.objects.count(), 2)
+
+    def test_reused_key(self):
+        self.place_order(self.data)
+        response = self.place_order([{'id': self.product.id, 'count': 2}])
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(Order.objects.count(), 1)
+
+    def test_pending(self):
+        self.create_pending(timezone.now() + datetime.timedelta(seconds=settings.IDEMPOTENCY_KEY_LEASE))
+        self.assertEqual(self.place_order(self.data).status_code, 409)
+        self.assertFalse(Order.objects.exists())
+
+    def test_expired_lease(self):
+        record = self.create_pending(timezone.now() - datetime.timedelta(seconds=1))
+        response = self.place_order(self.data)
+        self.assertEqual(response.status_code, 200)
+        record.refresh_from_db()
+        self.assertEqual((record.status_code, record.response), (200, response.json()))
+        self.assertEqual(self.place_order(self.data).json(), response.json())
+        self.assertEqual(Order.objects.count(), 1)
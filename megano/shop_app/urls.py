@@ -2,14 +2,17 @@ from django.urls import path
 from .views import (
     CategoriesAPIView,
     CatalogAPIView,
+    CatalogFacetsAPIView,
     ProductsPopularAPIView,
     ProductsLimitedAPIView,
     SalesAPIView,
     BannersAPIView,
+    ProductSearchAPIView,
     ProductAPIView,
-    ReviewsCreateAPIView,
+    ProductReviewsAPIView,
     TagAPIView,
     PaymentAPIView,
+    PaymentStatusAPIView,
     BasketView,
     OrderView,
     OrderIDView,
@@ -21,14 +24,17 @@ app_name = 'shop_app'
 urlpatterns = [
     path('categories/', CategoriesAPIView.as_view(), name='categories'),
     path('catalog/', CatalogAPIView.as_view(), name='catalog'),
+    path('catalog/facets/', CatalogFacetsAPIView.as_view(), name='catalog_facets'),
     path('product/<int:pk>/', ProductAPIView.as_view(), name='products_id'),
-    path('product/<int:pk>/reviews', ReviewsCreateAPIView.as_view(), name='products_id_review'),
+    path('product/<int:pk>/reviews', ProductReviewsAPIView.as_view(), name='products_id_review'),
     path('products/popular/', ProductsPopularAPIView.as_view(), name='products_popular'),
     path('products/limited/', ProductsLimitedAPIView.as_view(), name='products_limited'),
+    path('products/search/', ProductSearchAPIView.as_view(), name='products_search'),
     path('sales/', SalesAPIView.as_view(), name='sales'),
     path('banners/', BannersAPIView.as_view(), name='banners'),
     path('tags/', TagAPIView.as_view(), name='tags'),
     path('payment/<int:id>', PaymentAPIView.as_view(), name='payment'),
+    path('payment/<int:id>/status', PaymentStatusAPIView.as_view(), name='payment_status'),
     path('basket', BasketView.as_view(), name='basket'),
     path('orders', OrderView.as_view(), name='orders'),
     path('order/<int:id>', OrderIDView.as_view(), name='orders_detail'),
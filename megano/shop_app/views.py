@@ -1,12 +1,21 @@
 import json
-
-from django.contrib.auth.mixins import UserPassesTestMixin, LoginRequiredMixin
-from django.urls import reverse_lazy
+from decimal import Decimal
+
+from django.conf import settings
+from django.contrib.auth.mixins import UserPassesTestMixin
+from django.db import transaction
+from django.db.models import F, Prefetch
+from django.shortcuts import get_object_or_404
+from django.urls import reverse, reverse_lazy
+from django.utils.decorators import method_decorator
+from django.views.decorators.http import condition
 from rest_framework.views import APIView
+from rest_framework.permissions import IsAuthenticatedOrReadOnly
 from rest_framework.request import Request
 from rest_framework.response import Response
-from rest_framework import mixins
+from rest_framework import exceptions, mixins
 from rest_framework.generics import (
+    GenericAPIView,
     ListAPIView,
     RetrieveAPIView,
     CreateAPIView,
@@ -19,313 +28,449 @@ from rest_framework.filters import OrderingFilter
 
 from .models import (
     Product,
-    Category,
+    ImageProduct,
     Sale,
     Review,
-    Tag,
     Order, ProductOptions,
+    PaymentJob,
 )
 from .serializers import (
-    CategoriesSerializer,
+    BasketOperationSerializer,
+    OrderLineSerializer,
     ProductSerializer,
     CatalogPagination,
+    CatalogCursorPagination,
     SaleSerializer,
     ProductIdSerializer,
     ReviewSerializer,
-    TagSerializer,
     PaymentSerializer, OrderSerializer,
+    OrderListSerializer,
+    OrderCursorPagination,
+    ReviewCursorPagination,
+)
+from .filters import (
+    ProductFilter,
+    CustomOrderingFilter,
+    CustomDjangoFilterBackend,
+    OrderFilter,
 )
-from .filters import ProductFilter, CustomOrderingFilter, CustomDjangoFilterBackend
 from .basket import Basket
+from .cache import (
+    CATALOG,
+    SALES,
+    SOLD,
+    STOCK,
+    CachedResponseMixin,
+    catalog_etag,
+    get_cache,
+    make_versioned_key,
+    product_etag,
+    product_last_modified,
+)
+from .categories import get_category_tree
+from .facets import get_facets
+from .idempotency import idempotent
+from .inventory import OutOfStock, reserve_stock
+from .payments import enqueue_payment
+from .pricing import get_prices, get_sale_prices
+from .ranking import get_limited_ids, get_popular_ids, get_ranked_products
+from .search import get_search_backend
+from .tags import get_category_tags
+
+
+class CategoriesAPIView(APIView):
+    """
+    Menu of the root categories and their subcategories from the snapshot
+    of the category tree
+    """
 
-
-class CategoriesAPIView(ListAPIView):
-    queryset = Category.objects.select_related('parent', 'image').filter(level=0)
-    serializer_class = CategoriesSerializer
+    def get(self, request, *args, **kwargs):
+        return Response(get_category_tree().menu)
 
 
+@method_decorator(condition(etag_func=catalog_etag), name='get')
 class CatalogAPIView(ListAPIView):
     queryset = Product.objects\
         .select_related('category')\
-        .prefetch_related('images', 'tags', 'reviews').distinct()
+        .prefetch_related('images', 'tags')
     serializer_class = ProductSerializer
     pagination_class = CatalogPagination
     filter_backends = (CustomDjangoFilterBackend, CustomOrderingFilter)
     filterset_class = ProductFilter
-    ordering_fields = ('rating', 'price_p', 'reviews', 'data_created')
+    ordering_fields = ('rating', 'price_p', 'reviews_count', 'data_created')
+
+    @property
+    def paginator(self):
+        """
+        Keyset pagination is used when the request carries a cursor parameter
+        """
+        if not hasattr(self, '_paginator'):
+            if CatalogCursorPagination.cursor_query_param in self.request.query_params:
+                self._paginator = CatalogCursorPagination()
+            else:
+                self._paginator = self.pagination_class()
+        return self._paginator
+
+
+class CatalogFacetsAPIView(GenericAPIView):
+    """
+    Counts of the catalog filter values for the current filter state, the
+    values of each filter are counted as if that filter were not set
+    """
+    queryset = Product.objects.all()
+    filter_backends = (CustomDjangoFilterBackend,)
+    filterset_class = ProductFilter
+    cache_ignored_params = ('currentPage', 'page', 'limit', 'sort', 'sortType', 'cursor')
 
+    def get(self, request, *args, **kwargs):
+        cache = get_cache()
+        timeout = settings.CATALOG_FACETS_CACHE_TIMEOUT
+        key = make_versioned_key(
+            'shop_app:catalog_facets',
+            request.query_params,
+            self.cache_ignored_params,
+            resources=(CATALOG, STOCK),
+        )
+        data = cache.get(key) if timeout else None
+        if data is None:
+            backend, = self.filter_backends
+            filterset = backend().get_valid_filterset(request, self.get_queryset(), self)
+            data = get_facets(filterset, price_buckets=settings.CATALOG_FACETS_PRICE_BUCKETS)
+            if timeout:
+                cache.set(key, data, timeout)
+        return Response(data=data, status=200)
 
-class ProductsPopularAPIView(ListAPIView):
-    queryset = Product.objects\
-        .select_related('category')\
-        .prefetch_related('images', 'tags', 'reviews')\
-        .order_by('-quantity_sold', 'rating')[:10]
+
+class ProductsPopularAPIView(CachedResponseMixin, ListAPIView):
+    """
+    Best selling products, the window parameter limits sales to the last days;
+    the response follows the payments and, as the cards show the stock, the
+    stock changes
+    """
     serializer_class = ProductSerializer
+    cache_resources = (CATALOG, STOCK, SOLD)
+
+    def get_queryset(self):
+        window = self.request.query_params.get('window')
+        if window is not None:
+            try:
+                window = int(window)
+            except ValueError:
+                raise exceptions.ValidationError({'window': ['A valid integer is required.']})
+            if window < 1:
+                raise exceptions.ValidationError({'window': ['Ensure this value is greater than or equal to 1.']})
+            window = min(window, settings.RANKING_MAX_WINDOW_DAYS)
+        queryset = Product.objects\
+            .select_related('category')\
+            .prefetch_related('images', 'tags')
+        return get_ranked_products(queryset, get_popular_ids(window=window))
 
 
-class ProductsLimitedAPIView(ListAPIView):
-    queryset = Product.objects\
-        .select_related('category')\
-        .prefetch_related('images', 'tags', 'reviews')\
-        .order_by('count_p', '-rating')[:10]
+class ProductsLimitedAPIView(CachedResponseMixin, ListAPIView):
+    """
+    Products running out of stock, the response follows the stock changes
+    """
     serializer_class = ProductSerializer
+    cache_resources = (CATALOG, STOCK)
+
+    def get_queryset(self):
+        queryset = Product.objects\
+            .select_related('category')\
+            .prefetch_related('images', 'tags')
+        return get_ranked_products(queryset, get_limited_ids())
 
 
-class SalesAPIView(ListAPIView):
+class SalesAPIView(CachedResponseMixin, ListAPIView):
+    """
+    Sale cards: a page costs the count, the sales with their products and
+    the images, whatever the page size
+    """
     queryset = Sale.objects\
         .select_related('product')\
-        .prefetch_related('product__images')\
+        .only('sale_price', 'data_from', 'data_to', 'product__id', 'product__price_p', 'product__title')\
+        .prefetch_related(Prefetch('product__images', ImageProduct.objects.only('src', 'alt', 'product')))\
         .order_by('data_from')\
         .filter(status=True)
     serializer_class = SaleSerializer
     pagination_class = CatalogPagination
+    cache_resources = (CATALOG, SALES)
 
 
-class BannersAPIView(ListAPIView):
-    queryset = Product.objects\
-        .select_related('category')\
-        .prefetch_related('images', 'tags', 'reviews').all()
+class ProductSearchAPIView(APIView):
+    """
+    Ranked product matches with the found words highlighted
+    """
+
+    def get(self, request, *args, **kwargs):
+        query = request.query_params.get('q', '')
+        limit = request.query_params.get('limit')
+        if limit is None:
+            limit = settings.PRODUCT_SEARCH_LIMIT
+        else:
+            try:
+                limit = max(1, min(int(limit), settings.PRODUCT_SEARCH_LIMIT))
+            except ValueError:
+                return Response(data={'limit': ['A valid integer is required.']}, status=400)
+        data = get_search_backend().search(query, limit=limit)
+        return Response(data=data, status=200)
+
+
+class BannersAPIView(CachedResponseMixin, ListAPIView):
+    """
+    Featured products first, the free banner slots are filled by the best rated
+    ones; only available products are shown so the response follows the stock
+    """
     serializer_class = ProductSerializer
+    cache_resources = (CATALOG, STOCK)
+
+    def get_queryset(self):
+        return Product.objects\
+            .select_related('category')\
+            .prefetch_related('images', 'tags')\
+            .filter(available=True)\
+            .order_by('-featured', F('rating').desc(nulls_last=True), 'id')[:settings.BANNERS_LIMIT]
 
 
+@method_decorator(condition(etag_func=product_etag, last_modified_func=product_last_modified), name='get')
 class ProductAPIView(RetrieveAPIView):
-    queryset = Product.objects\
-        .select_related('category')\
-        .prefetch_related('images', 'tags', 'reviews', 'specifications')
     serializer_class = ProductIdSerializer
 
+    def get_queryset(self):
+        """
+        The product embeds only its newest reviews, the rest are loaded
+        page by page from the reviews endpoint
+        """
+        first_reviews = Review.objects\
+            .select_related('user')\
+            .order_by('-date_created', '-id')[:settings.PRODUCT_EMBEDDED_REVIEWS]
+        return Product.objects\
+            .select_related('category')\
+            .prefetch_related(
+                'images',
+                'tags',
+                'specifications',
+                Prefetch('reviews', queryset=first_reviews, to_attr='first_reviews'),
+            )
+
 
-class ReviewsCreateAPIView(LoginRequiredMixin, CreateAPIView):
+class ProductReviewsAPIView(ListCreateAPIView):
     serializer_class = ReviewSerializer
+    pagination_class = ReviewCursorPagination
+    permission_classes = [IsAuthenticatedOrReadOnly]
 
     def get_queryset(self):
-        product_id = self.request.query_params['id']
-        queryset = Review.objects \
-            .select_related('user') \
-            .prefetch_related('product') \
-            .filter(product__id=product_id)
-        return queryset
+        return Review.objects\
+            .select_related('user')\
+            .filter(product=self.kwargs['pk'])
 
     def post(self, request, *args, **kwargs):
-        author = request.data.get('author')
-        email = request.data.get('email')
-        text = request.data.get('text')
-        rate = int(request.data.get('rate'))
-        product = Product.objects.get(pk=kwargs.get('pk'))
-        review = Review.objects.create(
-            user=request.user,
-            product=product,
-            text=text,
-            rate=rate,
-            )
-        reviews = Review.objects.filter(product=product)
-        serialized = ReviewSerializer(reviews, many=True)
-        return Response(serialized.data, status=200)
+        """
+        Publishes the review and answers with it and the updated review
+        counters of the product instead of the whole list of reviews
+        """
+        product = get_object_or_404(Product, pk=kwargs.get('pk'))
+        serializer = self.get_serializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user, product=product)
+        product.refresh_from_db(fields=['reviews_count', 'rating'])
+        return Response(
+            data={
+                'review': serializer.data,
+                'reviewsCount': product.reviews_count,
+                'rating': product.rating,
+            },
+            status=201,
+        )
 
 
-class TagAPIView(ListAPIView):
-    serializer_class = TagSerializer
+class TagAPIView(APIView):
+    """
+    Tags of the category and its descendants with their product counts,
+    looked up in the tag index by the category id
+    """
 
-    def get_queryset(self):
-        category_id = self.request.query_params.get('category')
-        subcutegories_qs = Category.objects.filter(parent=category_id)
+    def get(self, request: Request, *args, **kwargs):
+        category_id = request.query_params.get('category')
         if category_id:
-            family_category = [int(category_id)]
-            for subcategory in subcutegories_qs:
-                family_category.append(subcategory.id)
-            queryset = Tag.objects \
-                .prefetch_related('products') \
-                .filter(products__category__id__in=family_category)\
-                .distinct()
+            try:
+                category_id = int(category_id)
+            except ValueError:
+                return Response(data={'category': ['A valid integer is required.']}, status=400)
         else:
-            queryset = Tag.objects \
-                .prefetch_related('products') \
-                .all()
-        return queryset
+            category_id = None
+        return Response(get_category_tags(category_id))
 
 
 class PaymentAPIView(CreateAPIView):
     serializer_class = PaymentSerializer
     lookup_field = 'id'
 
+    @idempotent
     def post(self, request, *args, **kwargs):
+        """
+        Queues the payment of an order of the user for the payment worker
+        and answers 202 with the url where the client polls the payment
+        status; a paid order answers 409 and is never charged again
+        """
         serializer = self.get_serializer(data=request.data)
-        if serializer.is_valid(raise_exception=True):
-            order = Order.objects.get(id=self.kwargs.get('id'))
-            order.confirm_payment()
-            return Response(status=200)
-        else:
+        serializer.is_valid(raise_exception=True)
+        order = get_object_or_404(Order, id=self.kwargs.get('id'), user=request.user.pk)
+        if order.status == 'Paid':
+            return Response(data={'detail': 'The order is already paid'}, status=409)
+        job = enqueue_payment(order, serializer.validated_data)
+        return Response(
+            data={
+                'orderId': order.id,
+                'status': job.status,
+                'statusUrl': reverse('shop_app:payment_status', kwargs={'id': order.id}),
+            },
+            status=202,
+        )
+
+
+class PaymentStatusAPIView(APIView):
+    """
+    Status of the order and of its latest payment, read by two small queries
+    """
+
+    def get(self, request, *args, **kwargs):
+        order = Order.objects\
+            .filter(id=kwargs.get('id'), user=request.user.pk)\
+            .values('id', 'status')\
+            .first()
+        if order is None:
             return Response(status=404)
+        job = PaymentJob.objects\
+            .filter(order=order['id'])\
+            .order_by('-id')\
+            .values('status', 'attempts', 'error')\
+            .first()
+        return Response(data={
+            'orderId': order['id'],
+            'status': order['status'],
+            'payment': job,
+        })
 
 
 class BasketView(APIView):
+    """
+    Lines of the basket, the totals are added to the response when
+    requested with ?totals=1, the storefront reads a plain list.
+    PATCH applies a batch of line changes in one round trip
+    """
     success_url = reverse_lazy('shop_app/basket')
 
-    def get(self, request, *args, **kwargs):
-        basket = Basket(request)
-        products = Product.objects \
-            .select_related('category') \
-            .prefetch_related('images', 'tags', 'reviews') \
-            .filter(id__in=map(int, basket.basket.keys()))
-        data = []
-        for product in products:
-
-            image_list = []
-            for image in product.images.all():
-                image_list.append({'src': image.src.url,
-                                   'alt': image.alt})
-
-            tags_list = []
-            for tag in product.tags.all():
-                tags_list.append({'id': tag.id,
-                                  'name': tag.name})
-
-            product_data = {
-                "id": product.id,
-                "category": product.category.id,
-                "price": basket.basket[str(product.id)]['price'],
-                "count": basket.basket[str(product.id)]['count'],
-                "date": product.data_created,
-                "title": product.title,
-                "description": product.description,
-                "freeDelivery": product.free_delivery,
-                "images": image_list,
-                "tags": tags_list,
-                "reviews": product.reviews.count(),
-                "rating": product.rating,
-            }
-            data.append(product_data)
+    def get_response(self, basket: Basket) -> Response:
+        payload = basket.get_payload()
+        if self.request.query_params.get('totals') in ('1', 'true'):
+            return Response(data=payload, status=200)
+        return Response(data=payload['items'], status=200)
 
-        return Response(data=data, status=200)
+    def get(self, request, *args, **kwargs):
+        return self.get_response(Basket(request))
 
     def post(self, request, *args, **kwargs):
         basket = Basket(request)
         product_id = request.data.get('id')
         product_count = request.data.get('count')
-        product = Product.objects.get(id=product_id)
-        basket.add(product, product_count)
-        products = Product.objects\
-            .select_related('category')\
-            .prefetch_related('images', 'tags', 'reviews')\
-            .filter(id__in=map(int, basket.basket.keys()))
-        data = []
-        for product in products:
-
-            image_list = []
-            for image in product.images.all():
-                image_list.append({'src': image.src.url,
-                                   'alt': image.alt})
-
-            tags_list = []
-            for tag in product.tags.all():
-                tags_list.append({'id': tag.id,
-                                  'name': tag.name})
-
-            product_data = {
-                "id": product.id,
-                "category": product.category.id,
-                "price": basket.basket[str(product.id)]['price'],
-                "count": basket.basket[str(product.id)]['count'],
-                "date": product.data_created,
-                "title": product.title,
-                "description": product.description,
-                "freeDelivery": product.free_delivery,
-                "images": image_list,
-                "tags": tags_list,
-                "reviews": product.reviews.count(),
-                "rating": product.rating,
-            }
-            data.append(product_data)
-
-        return Response(data=data, status=200)
+        if int(product_id) not in get_prices([product_id]):
+            return Response(status=404)
+        basket.add(product_id, product_count)
+        return self.get_response(basket)
 
     def delete(self, request, *args, **kwargs):
         basket = Basket(request)
         product_id = request.data.get('id')
         product_count = request.data.get('count')
         basket.remove(product_id, product_count)
-        products = Product.objects\
-            .select_related('category')\
-            .prefetch_related('images', 'tags', 'reviews')\
-            .filter(id__in=map(int, basket.basket.keys()))
-        data = []
-        for product in products:
-
-            image_list = []
-            for image in product.images.all():
-                image_list.append({'src': image.src.url,
-                                   'alt': image.alt})
-
-            tags_list = []
-            for tag in product.tags.all():
-                tags_list.append({'id': tag.id,
-                                  'name': tag.name})
-
-            product_data = {
-                "id": product.id,
-                "category": product.category.id,
-                "price": basket.basket[str(product.id)]['price'],
-                "count": basket.basket[str(product.id)]['count'],
-                "date": product.data_created,
-                "title": product.title,
-                "description": product.description,
-                "freeDelivery": product.free_delivery,
-                "images": image_list,
-                "tags": tags_list,
-                "reviews": product.reviews.count(),
-                "rating": product.rating,
-            }
-            data.append(product_data)
-
-        return Response(data=data, status=200)
+        return self.get_response(basket)
+
+    def patch(self, request, *args, **kwargs):
+        """
+        Batch of {id, count, op} changes applied together, op is add, remove
+        or set; nothing is applied when one of the products does not exist
+        """
+        serializer = BasketOperationSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        operations = serializer.validated_data
+        product_ids = {operation['id'] for operation in operations}
+        missing = product_ids - get_prices(product_ids).keys()
+        if missing:
+            return Response(data={'missing': sorted(missing)}, status=404)
+        basket = Basket(request)
+        basket.apply(operations)
+        return self.get_response(basket)
 
 
 class OrderView(ListAPIView, CreateAPIView):
-    serializer_class = OrderSerializer
+    """
+    History of the orders in pages of OrderCursorPagination, filtered by
+    ?dateFrom=&dateTo=; the products are only loaded by /api/order/<id>
+    """
+    serializer_class = OrderListSerializer
+    pagination_class = OrderCursorPagination
+    filter_backends = (filters_rf.DjangoFilterBackend,)
+    filterset_class = OrderFilter
     login_url = '/sign-in/'
 
     def get_queryset(self, *args, **kwargs):
         return Order.objects \
-            .select_related('user') \
-            .prefetch_related('products_in_order',
-                              'options',
-                              'products_in_order__images',
-                              'products_in_order__tags',
-                              'products_in_order__reviews') \
+            .with_total_cost() \
+            .with_items_count() \
             .filter(user=self.request.user, status='accepted')
 
+    @idempotent
     def post(self, request, *args, **kwargs):
-        p_options = []
-        id_list = []
-        for item in request.data:
-            p_id = item.get('id')
-            p_price = item.get('price')
-            p_count = item.get('count')
-            p_options.append({
-                p_id: {
-                    'price_option': p_price,
-                    'count_option': p_count
-                }
-            })
-            id_list.append(p_id)
-        products = Product.objects.filter(id__in=id_list)
+        """
+        Creating the order with its lines in one transaction, the number of
+        queries does not depend on the number of lines. The lines are priced
+        from the catalog and the active sales, a price sent by the client is
+        ignored. The units are reserved until the order is paid, 409 lists
+        the products out of stock
+        """
+        serializer = OrderLineSerializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        product_ids = {item['id'] for item in serializer.validated_data}
+        products = Product.objects.in_bulk(product_ids)
+        if len(products) < len(product_ids):
+            return Response(status=404)
+        sale_prices = get_sale_prices()
+        lines = [
+            (item['id'], sale_prices.get(item['id'], products[item['id']].price_p), item['count'])
+            for item in serializer.validated_data
+        ]
+        counts = {}
+        for product_id, _, count in lines:
+            counts[product_id] = counts.get(product_id, 0) + count
+        try:
+            with transaction.atomic():
+                order = self.create_order(request.user, lines, products)
+                reserve_stock(order, counts)
+        except OutOfStock as error:
+            return Response(data={'outOfStock': error.product_ids}, status=409)
+        return Response(status=200, data={"orderId": order.id})
+
+    def create_order(self, user, lines: list, products: dict) -> Order:
         order = Order.objects.create(
-            user=request.user,
+            user=user,
             status='accepted',
+            total=sum((price * count for _, price, count in lines), Decimal(0)),
         )
-
-        order.products_in_order.set(products)
-        order.save()
-        for product in p_options:
-            for key, value in product.items():
-                product_options = ProductOptions.objects.create(
-                    id_product=key,
-                    price_option=value.get('price_option'),
-                    count_option=value.get('count_option'),
-                    order=order,
-                    product=products.get(id=key),
-                )
-        return Response(status=200, data={"orderId": order.id})
+        Order.products_in_order.through.objects.bulk_create([
+            Order.products_in_order.through(order_id=order.id, product_id=product_id)
+            for product_id in products
+        ])
+        ProductOptions.objects.bulk_create([
+            ProductOptions(
+                id_product=product_id,
+                price_option=price,
+                count_option=count,
+                order=order,
+                product=products[product_id],
+            )
+            for product_id, price, count in lines
+        ])
+        return order
 
 
 class OrderIDView(RetrieveAPIView, CreateAPIView, UpdateAPIView):
@@ -334,12 +479,11 @@ class OrderIDView(RetrieveAPIView, CreateAPIView, UpdateAPIView):
 
     def get_queryset(self, *args, **kwargs):
         return Order.objects \
-            .select_related('user') \
-            .prefetch_related('products_in_order',
-                              'options',
-                              'products_in_order__images',
-                              'products_in_order__tags',
-                              'products_in_order__reviews') \
+            .with_total_cost() \
+            .select_related('user', 'user__profile') \
+            .prefetch_related(Prefetch('options', ProductOptions.objects.select_related('product')),
+                              'options__product__images',
+                              'options__product__tags') \
             .filter(user=self.request.user)
 
     def post(self, request, *args, **kwargs):